@@ -5,6 +5,12 @@
 
 import os
 import time
+import threading
+import multiprocessing
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from typing import List, Dict, Optional
 from tqdm import tqdm
@@ -14,24 +20,56 @@ from pdf_chunker import PDFChunker
 from gemini_extractor import GeminiTitleExtractor
 from toc_merger import TOCMerger
 from pdf_toc_writer import PDFTOCWriter
+import json_utils
+from log_config import setup_logging
+
+# 自适应文件启动间隔的上限（秒）
+MAX_DELAY_BETWEEN_FILES = 60.0
+
+# 排队等待写入PDF的文件数上限，超过时先等待最早的写入完成
+MAX_PENDING_WRITES = 4
+
+# 已处理文件清单（JSON Lines，每处理成功一个文件追加一行）
+MANIFEST_FILENAME = '.pdf_toc_manifest.jsonl'
+
+
+def _write_toc(pdf_path: str, toc_entries: list, output_path: Optional[str], backup: bool) -> str:
+    """在写入进程中把目录写入PDF（模块级函数，便于进程池序列化）"""
+    return PDFTOCWriter().write_toc_to_pdf(pdf_path, toc_entries, output_path, backup=backup)
 
 
 class BatchPDFProcessor:
     """批量PDF处理器"""
     
-    def __init__(self, api_key: Optional[str] = None, max_pages: int = 1000):
+    def __init__(self, api_key: Optional[str] = None, max_pages: int = 1000, max_workers: int = 4,
+                 use_cache: bool = True, chunk_workers: int = 4, manifest_path: Optional[str] = None,
+                 write_workers: int = 2):
         """
         初始化批量处理器
         
         Args:
             api_key: Google AI API密钥
             max_pages: 每个处理块的最大页数
+            max_workers: 同时处理的最大文件数
+            use_cache: 是否使用目录结果缓存
+            chunk_workers: 单个文件内同时提取的最大块数
+            manifest_path: 已处理文件清单路径，None 则放在输出文件夹（原地处理时为输入文件夹）
+            write_workers: 写入PDF目录的进程数
         """
         self.chunker = PDFChunker(max_pages=max_pages)
-        self.extractor = GeminiTitleExtractor(api_key=api_key)
+        self.extractor = GeminiTitleExtractor(api_key=api_key, use_cache=use_cache)
         self.merger = TOCMerger()
-        self.writer = PDFTOCWriter()
         self.max_pages = max_pages
+        self.max_workers = max(1, max_workers)
+        self.chunk_workers = max(1, chunk_workers)
+        self.write_workers = max(1, write_workers)
+        
+        # 并发处理时保护统计数据和文件启动节奏
+        self._stats_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._next_start_time = 0.0
+        self._delay = 0.0
+        self._seen_headers = None
         
         # 处理统计
         self.stats = {
@@ -44,6 +82,12 @@ class BatchPDFProcessor:
         
         # 失败文件记录
         self.failed_files = []
+        
+        # 已处理文件清单（内存中为输出路径集合）
+        self.manifest_path = manifest_path
+        self._processed_outputs = set()
+        self._manifest_file = None
+        self._manifest_lock = threading.Lock()
     
     def find_pdf_files(self, folder_path: str, recursive: bool = True) -> List[Path]:
         """
@@ -63,16 +107,73 @@ class BatchPDFProcessor:
         if not folder.is_dir():
             raise ValueError(f"路径不是文件夹: {folder_path}")
         
-        # 查找PDF文件
-        if recursive:
-            pdf_files = list(folder.rglob("*.pdf"))
-        else:
-            pdf_files = list(folder.glob("*.pdf"))
+        # 查找PDF文件（直接使用 os.scandir 的目录项，避免逐个创建 Path 对象）
+        pdf_paths = self._scan_pdf_paths(str(folder), recursive)
         
         # 按文件名排序
-        pdf_files.sort(key=lambda x: x.name.lower())
+        pdf_paths.sort(key=lambda path: os.path.basename(path).lower())
+        
+        return [Path(path) for path in pdf_paths]
+    
+    def _scan_pdf_paths(self, root: str, recursive: bool, max_workers: int = 16) -> List[str]:
+        """
+        使用 os.scandir 遍历目录，返回PDF文件路径字符串
+        
+        递归时各子文件夹交给线程池并发读取，网络文件系统上多个目录请求可以同时进行
+        
+        Args:
+            root: 起始目录
+            recursive: 是否进入子文件夹
+            max_workers: 并发读取目录的线程数
+            
+        Returns:
+            List[str]: PDF文件路径
+        """
+        pdf_paths, subdirs = self._scan_dir(root)
+        if not recursive or not subdirs:
+            return pdf_paths
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = {pool.submit(self._scan_dir, subdir) for subdir in subdirs}
+            
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found, subdirs = future.result()
+                    pdf_paths.extend(found)
+                    pending.update(pool.submit(self._scan_dir, subdir) for subdir in subdirs)
+        
+        return pdf_paths
+    
+    def _scan_dir(self, path: str):
+        """
+        读取单个目录
+        
+        Args:
+            path: 目录路径
+            
+        Returns:
+            Tuple[List[str], List[str]]: (PDF文件路径, 子文件夹路径)
+        """
+        pdf_paths = []
+        subdirs = []
+        
+        try:
+            entries = os.scandir(path)
+        except OSError:
+            return pdf_paths, subdirs
         
-        return pdf_files
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.lower().endswith('.pdf') and entry.is_file():
+                        pdf_paths.append(entry.path)
+                except OSError:
+                    continue
+        
+        return pdf_paths, subdirs
     
     def process_folder(self, 
                       input_folder: str, 
@@ -92,7 +193,8 @@ class BatchPDFProcessor:
             backup: 是否创建备份
             save_json: 是否保存JSON格式的目录
             skip_existing: 是否跳过已处理的文件
-            delay_between_files: 文件间处理延迟（秒）
+            delay_between_files: 相邻文件开始处理的初始间隔（秒），0 表示不限制；
+                处理过程中按 Gemini 返回的限流信息自动调整
             
         Returns:
             Dict: 处理结果统计
@@ -121,48 +223,90 @@ class BatchPDFProcessor:
         self.stats['total_files'] = len(pdf_files)
         self.failed_files = []
         
-        # 处理每个PDF文件
+        # 加载已处理文件清单
+        manifest_path = self.manifest_path or os.path.join(output_folder or input_folder, MANIFEST_FILENAME)
+        self._load_manifest(manifest_path)
+        
+        # 检查是否跳过已处理的文件
+        pending_files = []
+        for pdf_file in pdf_files:
+            if skip_existing and self._is_already_processed(pdf_file, output_folder):
+                print(f"⏭️  跳过已处理文件: {pdf_file.name}")
+            else:
+                pending_files.append(pdf_file)
+        
+        # 并发处理PDF文件（文件启动间隔从 delay_between_files 开始，按服务端限流信息自适应调整）
+        # 提取完成的文件交给写入进程池写入目录，写入与后续文件的 Gemini 调用重叠进行
+        self._next_start_time = 0.0
+        self._delay = delay_between_files
+        self._seen_headers = self.extractor.last_headers
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        write_pool = ProcessPoolExecutor(max_workers=self.write_workers,
+                                         mp_context=multiprocessing.get_context('spawn'))
+        write_futures = deque()
         with tqdm(total=len(pdf_files), desc="处理进度", unit="文件") as pbar:
-            for pdf_file in pdf_files:
-                try:
-                    # 更新进度条描述
-                    pbar.set_description(f"处理: {pdf_file.name}")
+            pbar.update(len(pdf_files) - len(pending_files))
+            
+            futures = {
+                executor.submit(
+                    self._prepare_single_file_paced,
+                    pdf_file,
+                    output_folder,
+                    save_json
+                ): pdf_file
+                for pdf_file in pending_files
+            }
+            
+            try:
+                for future in as_completed(futures):
+                    pdf_file = futures[future]
+                    try:
+                        prepared = future.result()
+                    except Exception as e:
+                        prepared = None
+                        pbar.write(f"❌ 处理 {pdf_file.name} 时发生错误: {e}")
                     
-                    # 检查是否跳过已处理的文件
-                    if skip_existing and self._is_already_processed(pdf_file, output_folder):
-                        pbar.write(f"⏭️  跳过已处理文件: {pdf_file.name}")
+                    if prepared is None:
+                        self._mark_failed(pdf_file)
+                        pbar.write(f"❌ 失败: {pdf_file.name}")
                         pbar.update(1)
-                        continue
-                    
-                    # 处理单个文件
-                    success = self._process_single_file(
-                        pdf_file, 
-                        output_folder, 
-                        backup, 
-                        save_json
-                    )
-                    
-                    if success:
-                        self.stats['processed_files'] += 1
-                        pbar.write(f"✅ 完成: {pdf_file.name}")
                     else:
-                        self.stats['failed_files'] += 1
-                        self.failed_files.append(str(pdf_file))
-                        pbar.write(f"❌ 失败: {pdf_file.name}")
+                        # 限制排队的写入数，避免提取远快于写入时积压大量目录
+                        if len(write_futures) >= MAX_PENDING_WRITES:
+                            self._finish_write(write_futures.popleft(), pbar)
+                        
+                        final_toc, output_path = prepared
+                        try:
+                            write_future = write_pool.submit(
+                                _write_toc,
+                                str(pdf_file),
+                                final_toc,
+                                str(output_path) if output_path != pdf_file else None,
+                                backup
+                            )
+                        except BrokenProcessPool as e:
+                            self._mark_failed(pdf_file)
+                            pbar.write(f"❌ 写入 {pdf_file.name} 的目录时发生错误: {e}")
+                            pbar.update(1)
+                        else:
+                            write_futures.append((pdf_file, output_path, write_future))
                     
-                    # 文件间延迟（避免API限制）
                     if delay_between_files > 0:
-                        time.sleep(delay_between_files)
+                        self._delay = self._adapt_delay(self._delay, delay_between_files)
+            
+            except KeyboardInterrupt:
+                pbar.write("\n⚠️  用户中断处理")
+                for future in futures:
+                    future.cancel()
+            finally:
+                executor.shutdown(wait=True)
                 
-                except KeyboardInterrupt:
-                    pbar.write("\n⚠️  用户中断处理")
-                    break
-                except Exception as e:
-                    self.stats['failed_files'] += 1
-                    self.failed_files.append(str(pdf_file))
-                    pbar.write(f"❌ 处理 {pdf_file.name} 时发生错误: {e}")
+                # 等待已提交的写入全部完成
+                while write_futures:
+                    self._finish_write(write_futures.popleft(), pbar)
+                write_pool.shutdown(wait=True)
                 
-                pbar.update(1)
+                self._close_manifest()
         
         # 计算处理时间
         self.stats['processing_time'] = time.time() - start_time
@@ -172,22 +316,112 @@ class BatchPDFProcessor:
         
         return self.stats
     
-    def _process_single_file(self, 
-                           pdf_file: Path, 
-                           output_folder: Optional[str], 
-                           backup: bool, 
-                           save_json: bool) -> bool:
+    def _prepare_single_file_paced(self,
+                                   pdf_file: Path,
+                                   output_folder: Optional[str],
+                                   save_json: bool):
+        """等待文件启动间隔后提取单个PDF文件的目录（在线程池中执行）"""
+        self._wait_for_start_slot()
+        return self._prepare_single_file(pdf_file, output_folder, save_json)
+    
+    def _finish_write(self, write_job: tuple, pbar: tqdm):
+        """
+        等待一个文件的目录写入完成并更新统计
+        
+        Args:
+            write_job: (pdf_file, output_path, write_future)
+            pbar: 进度条
+        """
+        pdf_file, output_path, write_future = write_job
+        try:
+            write_future.result()
+            self._record_processed(output_path)
+            with self._stats_lock:
+                self.stats['processed_files'] += 1
+            pbar.write(f"✅ 完成: {pdf_file.name}")
+        except Exception as e:
+            self._mark_failed(pdf_file)
+            pbar.write(f"❌ 写入 {pdf_file.name} 的目录时发生错误: {e}")
+        
+        pbar.update(1)
+    
+    def _mark_failed(self, pdf_file: Path):
+        """记录处理失败的文件"""
+        with self._stats_lock:
+            self.stats['failed_files'] += 1
+            self.failed_files.append(str(pdf_file))
+    
+    def _wait_for_start_slot(self):
+        """控制文件启动节奏：相邻两个文件的开始时间至少间隔当前的 self._delay 秒"""
+        with self._start_lock:
+            if self._delay <= 0:
+                return
+            now = time.monotonic()
+            start_time = max(now, self._next_start_time)
+            self._next_start_time = start_time + self._delay
+        
+        if start_time > now:
+            time.sleep(start_time - now)
+    
+    def _adapt_delay(self, delay: float, base: float) -> float:
+        """
+        根据最近一次 Gemini 响应头调整文件启动间隔
+        
+        - 有新的 Retry-After 时推迟下一个文件的开始时间（只生效一次，不改变间隔）
+        - 剩余配额充足时缩短间隔，配额紧张时拉长间隔
+        - 没有新的限流信息时逐步回落到初始间隔
+        
+        响应头由所有并发的文件共享，只反映最近完成的一次调用，已处理过的响应头不再重复使用
+        
+        Args:
+            delay: 当前间隔（秒）
+            base: 初始间隔（秒）
+            
+        Returns:
+            float: 新的间隔（秒）
+        """
+        headers = self.extractor.last_headers
+        is_new = headers is not self._seen_headers
+        self._seen_headers = headers
+        
+        if is_new:
+            try:
+                retry_after = headers.get('retry-after')
+                if retry_after:
+                    self._postpone_next_start(min(float(retry_after), MAX_DELAY_BETWEEN_FILES))
+                    return delay
+                
+                remaining = headers.get('x-ratelimit-remaining-requests', headers.get('x-ratelimit-remaining'))
+                if remaining is not None:
+                    if int(remaining) > 10:
+                        return delay * 0.9
+                    return min(max(delay, 0.1) * 1.5, MAX_DELAY_BETWEEN_FILES)
+            except ValueError:
+                pass
+        
+        if delay > base:
+            return max(base, delay * 0.9)
+        return delay
+    
+    def _postpone_next_start(self, seconds: float):
+        """下一个文件至少在 seconds 秒之后才开始处理"""
+        with self._start_lock:
+            self._next_start_time = max(self._next_start_time, time.monotonic() + seconds)
+    
+    def _prepare_single_file(self,
+                             pdf_file: Path,
+                             output_folder: Optional[str],
+                             save_json: bool):
         """
-        处理单个PDF文件
+        提取单个PDF文件的目录（分块、调用 Gemini、合并，需要时保存JSON），不写入PDF
         
         Args:
             pdf_file: PDF文件路径
             output_folder: 输出文件夹
-            backup: 是否备份
             save_json: 是否保存JSON
             
         Returns:
-            bool: 是否处理成功
+            Optional[Tuple[List[TOCEntry], Path]]: (合并后的目录, 输出路径)，失败时返回 None
         """
         try:
             # 确定输出路径
@@ -199,52 +433,74 @@ class BatchPDFProcessor:
             # 步骤1: 分块处理PDF
             chunks = self.chunker.chunk_pdf(str(pdf_file))
             
-            # 步骤2: 提取标题
-            all_toc_entries = []
+            # 步骤2: 相邻小块合并为一次请求，各组并发提取（结果保持块的原始顺序）
+            # 边分块边提交：最多 chunk_workers 个组在处理中，内存中不会同时保留整个文档的块
+            results = {}
+            with closing(chunks), ThreadPoolExecutor(max_workers=self.chunk_workers) as pool:
+                pending = {}
+                
+                def collect(done):
+                    """记录已完成组中各块的结果"""
+                    for future in done:
+                        i = pending.pop(future)
+                        for k, toc_entries in enumerate(future.result()):
+                            results[i + k] = toc_entries
+                
+                i = 0
+                for group in self.extractor.group_chunks(chunks):
+                    if len(pending) >= self.chunk_workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    
+                    pending[pool.submit(self._extract_group, group)] = i
+                    i += len(group)
+                
+                collect(as_completed(list(pending)))
             
-            for chunk_bytes, start_page, end_page in chunks:
-                try:
-                    toc_entries = self.extractor.extract_titles_from_pdf_bytes(
-                        chunk_bytes, start_page, end_page
-                    )
-                    all_toc_entries.append(toc_entries)
-                except Exception as e:
-                    print(f"   块 {start_page}-{end_page} 处理失败: {e}")
-                    # 继续处理其他块
-                    all_toc_entries.append([])
+            all_toc_entries = [results[i] for i in range(len(results))]
             
             # 步骤3: 合并结果
             final_toc = self.merger.merge_toc_entries(all_toc_entries)
             
             if not final_toc:
                 print(f"   警告: {pdf_file.name} 未提取到任何目录条目")
-                return False
+                return None
             
             # 更新统计
-            self.stats['total_toc_entries'] += len(final_toc)
+            with self._stats_lock:
+                self.stats['total_toc_entries'] += len(final_toc)
             
             # 步骤4: 保存JSON（如果需要）
             if save_json:
                 json_path = output_path.with_suffix('.json')
                 self.merger.save_toc_to_json(final_toc, str(json_path))
             
-            # 步骤5: 写入PDF目录
-            self.writer.write_toc_to_pdf(
-                str(pdf_file),
-                final_toc,
-                str(output_path) if output_path != pdf_file else None,
-                backup=backup
-            )
-            
-            return True
+            return final_toc, output_path
             
         except Exception as e:
             print(f"   处理 {pdf_file.name} 时发生错误: {e}")
-            return False
+            return None
+    
+    def _extract_group(self, group: list) -> list:
+        """
+        提取一组相邻块的标题，失败时该组各块返回空列表以便继续处理其他块
+        
+        Args:
+            group: (chunk_bytes, start_page, end_page) 列表
+            
+        Returns:
+            list: 与 group 一一对应的目录条目列表
+        """
+        try:
+            return self.extractor.extract_titles_batched(group)
+        except Exception as e:
+            start_page, end_page = group[0][1], group[-1][2]
+            print(f"   块 {start_page}-{end_page} 处理失败: {e}")
+            return [[] for _ in group]
     
     def _is_already_processed(self, pdf_file: Path, output_folder: Optional[str]) -> bool:
         """
-        检查文件是否已经处理过（简单检查是否有备份文件）
+        检查文件是否已经处理过（查询已处理文件清单）
         
         Args:
             pdf_file: PDF文件路径
@@ -253,17 +509,55 @@ class BatchPDFProcessor:
         Returns:
             bool: 是否已处理
         """
+        output_file = Path(output_folder) / pdf_file.name if output_folder else pdf_file
+        return os.path.abspath(output_file) in self._processed_outputs
+    
+    def _load_manifest(self, manifest_path: str):
+        """
+        读取已处理文件清单，并以追加方式打开以便记录新处理的文件
+        
+        Args:
+            manifest_path: 清单文件路径
+        """
+        self._close_manifest()
+        self._processed_outputs = set()
+        
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._processed_outputs.add(json_utils.loads(line)['output'])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        
         try:
-            if output_folder:
-                # 检查输出文件夹中是否有对应文件
-                output_file = Path(output_folder) / pdf_file.name
-                return output_file.exists()
-            else:
-                # 检查是否有备份文件
-                backup_file = pdf_file.with_name(f"{pdf_file.stem}_backup.pdf")
-                return backup_file.exists()
-        except:
-            return False
+            self._manifest_file = open(manifest_path, 'a', encoding='utf-8')
+        except OSError as e:
+            print(f"⚠️  无法写入处理清单 {manifest_path}: {e}")
+            self._manifest_file = None
+    
+    def _record_processed(self, output_path: Path):
+        """
+        将处理成功的文件追加到清单
+        
+        Args:
+            output_path: 写入目录后的PDF路径
+        """
+        output = os.path.abspath(output_path)
+        record = json.dumps({'output': output, 'processed_at': time.strftime('%Y-%m-%d %H:%M:%S')}, ensure_ascii=False)
+        
+        with self._manifest_lock:
+            self._processed_outputs.add(output)
+            if self._manifest_file:
+                self._manifest_file.write(record + '\n')
+                self._manifest_file.flush()
+    
+    def _close_manifest(self):
+        """关闭清单文件"""
+        with self._manifest_lock:
+            if self._manifest_file:
+                self._manifest_file.close()
+                self._manifest_file = None
     
     def _print_summary(self):
         """打印处理结果摘要"""
@@ -304,8 +598,7 @@ class BatchPDFProcessor:
             }
         }
         
-        with open(log_path, 'w', encoding='utf-8') as f:
-            json.dump(log_data, f, ensure_ascii=False, indent=2)
+        json_utils.dump_to_file(log_data, log_path)
         
         print(f"📄 处理日志已保存到: {log_path}")
 
@@ -325,6 +618,7 @@ def main():
     python batch_processor.py /path/to/pdf/folder
     python batch_processor.py input_folder --output output_folder
     python batch_processor.py folder --recursive --save-json --delay 2
+    python batch_processor.py folder --workers 8
         """
     )
     
@@ -336,11 +630,16 @@ def main():
     parser.add_argument('--no-backup', action='store_true', help='不创建备份文件')
     parser.add_argument('--save-json', action='store_true', help='保存目录为JSON文件')
     parser.add_argument('--no-skip', action='store_true', help='不跳过已处理的文件')
-    parser.add_argument('--delay', type=float, default=1.0, help='文件间处理延迟（秒）')
+    parser.add_argument('--delay', type=float, default=1.0, help='相邻文件开始处理的初始间隔（秒），运行中按限流信息自适应调整')
+    parser.add_argument('--workers', '-w', type=int, default=4, help='同时处理的最大文件数（默认4）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用目录结果缓存，总是重新调用Gemini')
     parser.add_argument('--log', help='保存处理日志的文件路径')
+    parser.add_argument('--verbose', '-v', action='store_true', help='显示详细信息（包括每个提取到的标题）')
     
     args = parser.parse_args()
     
+    setup_logging(verbose=args.verbose)
+    
     try:
         print("🚀 批量PDF处理器启动")
         print(f"📂 输入文件夹: {args.input_folder}")
@@ -355,7 +654,9 @@ def main():
         # 创建处理器
         processor = BatchPDFProcessor(
             api_key=args.api_key,
-            max_pages=args.max_pages
+            max_pages=args.max_pages,
+            max_workers=args.workers,
+            use_cache=not args.no_cache
         )
         
         # 开始批量处理
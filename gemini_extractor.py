@@ -1,22 +1,117 @@
 from google import genai
-from google.genai import types
+from google.genai import types, errors
+import httpx
+import importlib.util
 import json
 import io
+import logging
 import os
-from typing import List, Dict, Optional
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 from dataclasses import asdict
-from pdf_chunker import TOCEntry
+from pdf_chunker import PDFChunker, TOCEntry
+from rate_limiter import RateLimiter
+from toc_cache import TOCCache, content_hash
+import json_utils
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "gemini-2.5-flash"
+
+# Gemini 对 PDF 每页按固定 token 数计费
+TOKENS_PER_PDF_PAGE = 258
+
+# File API 上传的文件在服务端保留48小时，本地缓存略短于此
+FILE_API_CACHE_SIZE = 32
+FILE_API_CACHE_TTL = 47 * 3600
+
+# 合并到同一请求中的块总大小上限（内联请求上限为20MB）；合并请求失败时上限减半（不低于 BATCH_MIN_BYTES），
+# 之后每次合并请求成功再加倍，直到恢复 BATCH_MAX_BYTES
+BATCH_MAX_BYTES = 15 * 1024 * 1024
+BATCH_MIN_BYTES = 1024 * 1024
+
+# 块级目录缓存最多保留的条目数（按最近使用淘汰）
+CHUNK_CACHE_MAX_ENTRIES = int(os.getenv('GEMINI_TOC_CACHE_MAX_ENTRIES', '20000'))
+
+# 与 Gemini 之间的HTTP连接池大小
+HTTP_MAX_CONNECTIONS = 64
+
+# httpx 的 HTTP/2 支持依赖可选的 h2 包
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Gemini 请求重试：最多尝试次数，指数退避的初始和最大等待秒数
+MAX_RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# 标题中出现这些词时视为描述性文字或网址而非标题
+TITLE_BLACKLIST = ['具体而言', '根据', '.jp', '.com']
+_BLACKLIST_RE = re.compile('|'.join(map(re.escape, TITLE_BLACKLIST)))
+
+# 单个块的响应格式：标题列表
+_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string"},
+            "level": {"type": "integer"},
+            "page": {"type": "integer"}
+        },
+        "required": ["title", "level", "page"]
+    }
+}
+
+# 多块合并请求的响应格式：按 chunk_index 分组的标题列表
+_BATCH_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "chunks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "chunk_index": {"type": "integer"},
+                    "titles": _RESPONSE_SCHEMA
+                },
+                "required": ["chunk_index", "titles"]
+            }
+        }
+    },
+    "required": ["chunks"]
+}
+
+
+def _as_bytes(data) -> bytes:
+    """
+    把 memoryview、bytearray、mmap 等缓冲区对象统一为 bytes
+    
+    本身就是 bytes 时原样返回、不复制：Part.from_bytes 直接引用同一对象，
+    io.BytesIO 对 bytes 也是写时复制，因此同一块在内联请求、File API 上传和哈希之间共享一份内存。
+    其他缓冲区只在入口处转换一次（Part.from_bytes 的校验不接受 memoryview）。
+    """
+    return data if isinstance(data, bytes) else bytes(data)
 
 
 class GeminiTitleExtractor:
     """使用 Gemini 2.5 Flash 进行标题抽取 - 简化版"""
     
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, rpm: Optional[int] = None, tpm: Optional[int] = None,
+                 use_cache: bool = True, cache_dir: Optional[str] = None):
         """
         初始化 Gemini 客户端
         
         Args:
             api_key: Google AI API key，如果为 None 则从环境变量获取
+            rpm: 每分钟最大请求数，None 则从环境变量 GEMINI_RPM 获取（默认60）
+            tpm: 每分钟最大 token 数，None 则从环境变量 GEMINI_TPM 获取（默认1000000）
+            use_cache: 是否使用按内容哈希寻址的目录结果缓存
+            cache_dir: 缓存目录，None 则使用默认目录
         """
         if api_key is None:
             api_key = os.getenv('GOOGLE_AI_API_KEY')
@@ -25,7 +120,46 @@ class GeminiTitleExtractor:
             raise ValueError("需要提供 Google AI API key，请设置环境变量 GOOGLE_AI_API_KEY 或直接传入")
         
         # 创建客户端（新版API直接传入密钥）
-        self.client = genai.Client(api_key=api_key)
+        # 整个提取器复用同一个客户端：并发的块请求共享连接池，避免重复 TLS 握手；
+        # 安装了 h2（pip install httpx[http2]）时启用 HTTP/2，在少量连接上多路复用
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(client_args={
+                'http2': HTTP2_AVAILABLE,
+                'limits': httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS
+                )
+            })
+        )
+        
+        # 所有 Gemini 调用共享的令牌桶限流器
+        if rpm is None:
+            rpm = int(os.getenv('GEMINI_RPM', '60'))
+        if tpm is None:
+            tpm = int(os.getenv('GEMINI_TPM', '1000000'))
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        
+        # 最近一次 Gemini 响应的HTTP头（如 Retry-After、剩余配额）
+        self.last_headers = {}
+        
+        # 当前的合并请求大小上限（合并请求失败时减小，成功后逐步恢复）
+        self.batch_max_bytes = BATCH_MAX_BYTES
+        self._batch_limit_lock = threading.Lock()
+        
+        # 相同的PDF块不重复调用 Gemini
+        self.cache = TOCCache(cache_dir, max_entries=CHUNK_CACHE_MAX_ENTRIES) if use_cache else None
+        
+        # File API 上传句柄缓存：{内容哈希: (uploaded_file, 过期时间)}，按LRU淘汰
+        self._file_api_cache = OrderedDict()
+        self._file_api_lock = threading.Lock()
+        
+        # 文本提取复用同一个分块器
+        self._text_chunker = PDFChunker()
+        
+        # 正在提取中的块：{缓存键: Future}，相同内容的并发请求共享同一次调用
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
         
         # 简洁有效的系统指令
         self.system_instruction = """
@@ -39,19 +173,77 @@ class GeminiTitleExtractor:
 
 输出JSON格式：[{"title": "标题", "level": 层级, "page": 页码}]
 """
+        
+        # 生成配置在各次调用间不变，只构建一次
+        self._gen_config = types.GenerateContentConfig(
+            system_instruction=self.system_instruction,
+            response_mime_type="application/json",
+            response_schema=_RESPONSE_SCHEMA
+        )
+        self._batch_gen_config = types.GenerateContentConfig(
+            system_instruction=self.system_instruction,
+            response_mime_type="application/json",
+            response_schema=_BATCH_RESPONSE_SCHEMA
+        )
     
     def extract_titles_from_pdf_bytes(self, pdf_bytes: bytes, chunk_start_page: int, chunk_end_page: int) -> List[TOCEntry]:
         """
         直接从PDF字节流中提取标题
         
         Args:
-            pdf_bytes: PDF文件字节流
+            pdf_bytes: PDF文件字节流（也接受 memoryview 等缓冲区对象）
             chunk_start_page: 块起始页码
             chunk_end_page: 块结束页码
             
         Returns:
             List[TOCEntry]: 提取的标题列表
         """
+        pdf_bytes = _as_bytes(pdf_bytes)
+        cache_key = self._cache_key(pdf_bytes, chunk_start_page, chunk_end_page)
+        
+        # 相同内容和页码范围的块直接使用缓存结果
+        if self.cache:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        # 相同内容的块正由其他线程提取时（如批量处理中的重复文件），等待其结果而不重复调用 Gemini
+        future, is_owner = self._claim_inflight(cache_key)
+        if not is_owner:
+            return list(future.result())
+        
+        try:
+            titles = self._extract_titles_uncached(pdf_bytes, chunk_start_page, chunk_end_page, cache_key)
+            future.set_result(titles)
+            return titles
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._release_inflight(cache_key)
+    
+    def _claim_inflight(self, cache_key: str) -> Tuple[Future, bool]:
+        """
+        登记正在提取的块
+        
+        Returns:
+            Tuple[Future, bool]: (该块结果的 Future, 是否由调用方负责提取并设置结果)
+        """
+        with self._inflight_lock:
+            future = self._inflight.get(cache_key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._inflight[cache_key] = future
+            return future, True
+    
+    def _release_inflight(self, cache_key: str):
+        """提取结束（结果已写入缓存或 Future）后取消登记"""
+        with self._inflight_lock:
+            self._inflight.pop(cache_key, None)
+    
+    def _extract_titles_uncached(self, pdf_bytes: bytes, chunk_start_page: int, chunk_end_page: int, cache_key: str) -> List[TOCEntry]:
+        """调用 Gemini 提取标题，成功后写入缓存；失败时回退到文本提取"""
         try:
             # 修正的提示词 - 区分PDF页面序号和文档页码
             # 修正的提示词 - 区分PDF页面序号和文档页码
@@ -78,22 +270,181 @@ class GeminiTitleExtractor:
             
             if pdf_size_mb > 20:
                 # 使用File API处理大文件
-                return self._extract_with_file_api(pdf_bytes, prompt, chunk_start_page, chunk_end_page)
+                titles = self._extract_with_file_api(pdf_bytes, prompt, chunk_start_page, chunk_end_page)
             else:
                 # 直接处理小文件
-                return self._extract_direct(pdf_bytes, prompt, chunk_start_page, chunk_end_page)
+                titles = self._extract_direct(pdf_bytes, prompt, chunk_start_page, chunk_end_page)
+            
+            if self.cache and titles:
+                self.cache.set(cache_key, titles)
+            
+            return titles
                 
         except Exception as e:
             print(f"PDF标题提取过程中发生错误: {e}")
             # 如果失败，回退到文本提取方式
             return self._fallback_text_extraction(pdf_bytes, chunk_start_page)
     
+    def group_chunks(self, chunks: Iterable[Tuple[bytes, int, int]], max_bytes: Optional[int] = None) -> Iterator[List[Tuple[bytes, int, int]]]:
+        """
+        将相邻的小块分组，每组总大小不超过 max_bytes，以便合并到一次请求中
+        
+        Args:
+            chunks: (pdf_bytes, start_page, end_page) 序列，按需读取
+            max_bytes: 每组的最大字节数，None 则使用当前的 batch_max_bytes
+            
+        Yields:
+            List[Tuple[bytes, int, int]]: 一组相邻的块（超过上限的块单独成组）
+        """
+        group = []
+        group_bytes = 0
+        
+        for chunk in chunks:
+            chunk_size = len(chunk[0])
+            limit = max_bytes if max_bytes is not None else self.batch_max_bytes
+            if group and group_bytes + chunk_size > limit:
+                yield group
+                group = []
+                group_bytes = 0
+            group.append(chunk)
+            group_bytes += chunk_size
+        
+        if group:
+            yield group
+    
+    def extract_titles_batched(self, chunks: List[Tuple[bytes, int, int]]) -> List[List[TOCEntry]]:
+        """
+        在一次 Gemini 请求中提取多个块的标题
+        
+        Args:
+            chunks: (pdf_bytes, start_page, end_page) 列表，总大小应在内联请求限制内
+            
+        Returns:
+            List[List[TOCEntry]]: 与 chunks 一一对应的标题列表
+        """
+        chunks = [(_as_bytes(pdf_bytes), start_page, end_page) for pdf_bytes, start_page, end_page in chunks]
+        keys = [self._cache_key(pdf_bytes, start_page, end_page) for pdf_bytes, start_page, end_page in chunks]
+        results = [None] * len(chunks)
+        
+        # 已缓存的块不再发送
+        pending = []
+        for i, key in enumerate(keys):
+            cached = self.cache.get(key) if self.cache else None
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+        
+        # 相同内容的块正由其他线程提取时等待其结果，其余的块由本线程提取
+        owned = []
+        waiting = []
+        for i in pending:
+            future, is_owner = self._claim_inflight(keys[i])
+            (owned if is_owner else waiting).append((i, future))
+        
+        try:
+            indices = [i for i, _ in owned]
+            if len(indices) == 1:
+                pdf_bytes, start_page, end_page = chunks[indices[0]]
+                results[indices[0]] = self._extract_titles_uncached(pdf_bytes, start_page, end_page, keys[indices[0]])
+            elif indices:
+                try:
+                    batch_results = self._extract_batch_request([chunks[i] for i in indices])
+                    self._grow_batch_limit()
+                    for i, titles in zip(indices, batch_results):
+                        results[i] = titles
+                        if self.cache and titles:
+                            self.cache.set(keys[i], titles)
+                except Exception as e:
+                    print(f"合并请求失败，改为逐块处理: {e}")
+                    self._shrink_batch_limit(sum(len(chunks[i][0]) for i in indices))
+                    for i in indices:
+                        pdf_bytes, start_page, end_page = chunks[i]
+                        results[i] = self._extract_titles_uncached(pdf_bytes, start_page, end_page, keys[i])
+            
+            for i, future in owned:
+                future.set_result(results[i])
+        except BaseException as e:
+            for _, future in owned:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        finally:
+            for i, _ in owned:
+                self._release_inflight(keys[i])
+        
+        # 本线程的块都已完成后再等待其他线程，避免相互等待
+        for i, future in waiting:
+            results[i] = list(future.result())
+        
+        return results
+    
+    def _shrink_batch_limit(self, failed_bytes: int):
+        """合并请求失败后，把之后的分组上限降到失败请求大小的一半（不低于 BATCH_MIN_BYTES）"""
+        with self._batch_limit_lock:
+            new_limit = max(BATCH_MIN_BYTES, min(self.batch_max_bytes, failed_bytes) // 2)
+            if new_limit >= self.batch_max_bytes:
+                return
+            self.batch_max_bytes = new_limit
+        print(f"合并请求上限调整为 {new_limit:,} 字节")
+    
+    def _grow_batch_limit(self):
+        """合并请求成功后把分组上限加倍，最多恢复到 BATCH_MAX_BYTES，偶发错误不会永久缩小上限"""
+        with self._batch_limit_lock:
+            self.batch_max_bytes = min(BATCH_MAX_BYTES, self.batch_max_bytes * 2)
+    
+    def _extract_batch_request(self, chunks: List[Tuple[bytes, int, int]]) -> List[List[TOCEntry]]:
+        """将多个块放入同一请求，按 chunk_index 将结果分回各块"""
+        contents = []
+        ranges = []
+        for i, (pdf_bytes, start_page, end_page) in enumerate(chunks):
+            contents.append(f"=== CHUNK {i}: 第 {start_page}-{end_page} 页 ===")
+            contents.append(types.Part.from_bytes(data=pdf_bytes, mime_type='application/pdf'))
+            ranges.append(f"- CHUNK {i}: PDF第 {start_page}-{end_page} 页")
+        
+        prompt = f"""
+以上共有 {len(chunks)} 个PDF片段，每个片段前的标记给出了它在原PDF中的页码范围：
+{chr(10).join(ranges)}
+
+请分别提取每个片段的章节标题。
+
+要求：
+- 只要有编号的主要标题（1.、1.1、第一章等）
+- 最多3级，2-40字
+- 不要描述文字、日期、网址
+- 页码输出原PDF的实际页面序号（片段第1页对应其起始页码），不是文档内容的页码编号
+- 每个片段输出一项，chunk_index 与标记中的编号一致
+
+直接输出JSON：{{"chunks": [{{"chunk_index": 0, "titles": [{{"title": "标题", "level": 1, "page": 1}}]}}]}}
+"""
+        contents.append(prompt)
+        
+        estimated_tokens = sum(
+            self._estimate_pdf_tokens(start_page, end_page, "") for _, start_page, end_page in chunks
+        ) + len(prompt)
+        
+        response = self._generate_content(
+            contents=contents,
+            estimated_tokens=estimated_tokens,
+            config=self._batch_gen_config
+        )
+        
+        data = json_utils.loads(response.text)
+        
+        results = [[] for _ in chunks]
+        for item in data.get('chunks', []):
+            index = item.get('chunk_index')
+            if isinstance(index, int) and 0 <= index < len(chunks):
+                _, start_page, end_page = chunks[index]
+                results[index] = self._parse_items(item.get('titles', []), start_page, end_page)
+        
+        return results
+    
     def _extract_direct(self, pdf_bytes: bytes, prompt: str, chunk_start_page: int, chunk_end_page: int) -> List[TOCEntry]:
         """直接处理小PDF文件"""
         try:
             # 使用新的API格式处理PDF
-            response = self.client.models.generate_content(
-                model="gemini-2.5-flash",
+            response = self._generate_content(
                 contents=[
                     types.Part.from_bytes(
                         data=pdf_bytes,
@@ -101,22 +452,10 @@ class GeminiTitleExtractor:
                     ),
                     prompt
                 ],
-                config=types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    response_mime_type="application/json",
-                    response_schema={"type": "array", "items": {"type": "object", "properties": {"title": {"type": "string"}, "level": {"type": "integer"}, "page": {"type": "integer"}}, "required": ["title", "level", "page"]}}
-                )
+                estimated_tokens=self._estimate_pdf_tokens(chunk_start_page, chunk_end_page, prompt)
             )
             
-            # 提取文本用于智能分析器
-            try:
-                from pdf_chunker import PDFChunker
-                chunker = PDFChunker()
-                original_text = chunker.extract_text_from_chunk(pdf_bytes)
-            except:
-                original_text = ""
-            
-            return self._parse_response(response.text, chunk_start_page, chunk_end_page, original_text)
+            return self._parse_response(response.text, chunk_start_page, chunk_end_page)
             
         except Exception as e:
             print(f"直接处理PDF失败: {e}")
@@ -125,81 +464,132 @@ class GeminiTitleExtractor:
     def _extract_with_file_api(self, pdf_bytes: bytes, prompt: str, chunk_start_page: int, chunk_end_page: int) -> List[TOCEntry]:
         """使用File API处理大PDF文件"""
         try:
-            # 上传PDF到File API
-            pdf_io = io.BytesIO(pdf_bytes)
-            uploaded_file = self.client.files.upload(
-                file=pdf_io,
-                config=dict(mime_type='application/pdf')
-            )
+            # 上传PDF到File API（相同内容复用已上传的文件）
+            uploaded_file = self._get_uploaded_file(pdf_bytes)
             
             # 处理上传的文件
-            response = self.client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=[uploaded_file, prompt],
-                config=types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    response_mime_type="application/json",
-                    response_schema={"type": "array", "items": {"type": "object", "properties": {"title": {"type": "string"}, "level": {"type": "integer"}, "page": {"type": "integer"}}, "required": ["title", "level", "page"]}}
-                )
-            )
-            
-            # 提取文本用于智能分析器
             try:
-                from pdf_chunker import PDFChunker
-                chunker = PDFChunker()
-                original_text = chunker.extract_text_from_chunk(pdf_bytes)
-            except:
-                original_text = ""
+                response = self._generate_content(
+                    contents=[uploaded_file, prompt],
+                    estimated_tokens=self._estimate_pdf_tokens(chunk_start_page, chunk_end_page, prompt)
+                )
+            except errors.ClientError as e:
+                # 缓存的文件已在服务端失效，重新上传后再试一次
+                if e.code not in (403, 404):
+                    raise
+                uploaded_file = self._get_uploaded_file(pdf_bytes, refresh=True)
+                response = self._generate_content(
+                    contents=[uploaded_file, prompt],
+                    estimated_tokens=self._estimate_pdf_tokens(chunk_start_page, chunk_end_page, prompt)
+                )
             
-            return self._parse_response(response.text, chunk_start_page, chunk_end_page, original_text)
+            return self._parse_response(response.text, chunk_start_page, chunk_end_page)
             
         except Exception as e:
             print(f"File API处理失败: {e}")
             raise
     
-    def _parse_response(self, response_text: str, chunk_start_page: int, chunk_end_page: int, original_text: str = "") -> List[TOCEntry]:
+    def _get_uploaded_file(self, pdf_bytes: bytes, refresh: bool = False):
+        """
+        获取PDF在File API中的句柄，未缓存或已过期时上传
+        
+        Args:
+            pdf_bytes: PDF文件字节流
+            refresh: 是否忽略缓存强制重新上传
+            
+        Returns:
+            上传后的文件对象
+        """
+        key = content_hash(pdf_bytes)
+        
+        with self._file_api_lock:
+            cached = self._file_api_cache.pop(key, None)
+            if cached and not refresh and cached[1] > time.time():
+                self._file_api_cache[key] = cached
+                return cached[0]
+        
+        uploaded_file = self.client.files.upload(
+            file=io.BytesIO(pdf_bytes),
+            config=dict(mime_type='application/pdf')
+        )
+        
+        with self._file_api_lock:
+            self._file_api_cache[key] = (uploaded_file, time.time() + FILE_API_CACHE_TTL)
+            while len(self._file_api_cache) > FILE_API_CACHE_SIZE:
+                self._file_api_cache.popitem(last=False)
+        
+        return uploaded_file
+    
+    def _generate_content(self, contents: list, estimated_tokens: int,
+                          config: Optional[types.GenerateContentConfig] = None):
+        """经过限流器调用 Gemini 生成内容，遇到限流和服务端错误时指数退避重试（config 默认为单块标题列表格式）"""
+        if config is None:
+            config = self._gen_config
+        
+        for attempt in range(MAX_RETRY_ATTEMPTS):
+            self.limiter.acquire(estimated_tokens)
+            
+            try:
+                response = self.client.models.generate_content(
+                    model=MODEL_NAME,
+                    contents=contents,
+                    config=config
+                )
+                self._record_headers(getattr(response, 'sdk_http_response', None))
+                return response
+            except (errors.ServerError, errors.ClientError, httpx.TransportError) as e:
+                self._record_headers(getattr(e, 'response', None))
+                if not self._is_retryable(e) or attempt == MAX_RETRY_ATTEMPTS - 1:
+                    raise
+                
+                delay = self._retry_delay(e, attempt)
+                print(f"⏳ Gemini 请求失败（{e}），{delay:.1f} 秒后重试（第 {attempt + 1} 次）")
+                time.sleep(delay)
+    
+    def _record_headers(self, http_response):
+        """记录最近一次响应的HTTP头（键统一为小写），供调用方根据限流信息调整节奏"""
+        headers = getattr(http_response, 'headers', None)
+        if headers:
+            self.last_headers = {key.lower(): value for key, value in headers.items()}
+    
+    def _is_retryable(self, error: Exception) -> bool:
+        """限流（429）、服务端错误（5xx）和网络错误可以重试"""
+        if isinstance(error, errors.ClientError):
+            return error.code == 429
+        return True
+    
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """优先使用服务端返回的 Retry-After，否则为带抖动的指数退避"""
+        response = getattr(error, 'response', None)
+        retry_after = getattr(response, 'headers', {}).get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), RETRY_MAX_DELAY)
+            except ValueError:
+                pass
+        
+        delay = min(RETRY_BASE_DELAY * (2 ** attempt), RETRY_MAX_DELAY)
+        return delay + random.uniform(0, RETRY_BASE_DELAY)
+    
+    def _cache_key(self, pdf_bytes: bytes, chunk_start_page: int, chunk_end_page: int) -> str:
+        """缓存键：块内容哈希 + 页码范围 + 模型名"""
+        return f"{content_hash(pdf_bytes)}-{chunk_start_page}-{chunk_end_page}-{MODEL_NAME}"
+    
+    def _estimate_pdf_tokens(self, chunk_start_page: int, chunk_end_page: int, prompt: str) -> int:
+        """估算一次PDF请求消耗的 token 数（用于 TPM 限流）"""
+        page_count = max(1, chunk_end_page - chunk_start_page + 1)
+        return page_count * TOKENS_PER_PDF_PAGE + len(prompt) + len(self.system_instruction)
+    
+    def _parse_response(self, response_text: str, chunk_start_page: int, chunk_end_page: int) -> List[TOCEntry]:
         """解析API响应"""
         try:
             if not response_text:
                 return []
             
             # 解析AI返回的结果
-            ai_results = json.loads(response_text)
+            ai_results = json_utils.loads(response_text)
             
-            # 转换为TOCEntry对象
-            titles = []
-            for item in ai_results:
-                if isinstance(item, dict) and all(key in item for key in ['title', 'level', 'page']):
-                    title = item['title'].strip()
-                    level = min(int(item['level']), 3)  # 限制到3级
-                    
-                    # 页码处理 - 验证和调试
-                    raw_page = item['page']
-                    
-                    # 验证页码是否在合理范围内
-                    if chunk_start_page <= raw_page <= chunk_end_page:
-                        # 页码在预期范围内，直接使用
-                        actual_page = raw_page
-                    elif 1 <= raw_page <= (chunk_end_page - chunk_start_page + 1):
-                        # 页码是相对的，需要转换为绝对页码
-                        actual_page = raw_page + chunk_start_page - 1
-                        print(f"🔧 页码调整: {title} 从相对页码 {raw_page} 调整为绝对页码 {actual_page}")
-                    else:
-                        # 页码异常，使用默认值
-                        actual_page = chunk_start_page
-                        print(f"⚠️  页码异常: {title} 原页码 {raw_page}，使用默认页码 {actual_page}")
-                    
-                    print(f"📍 标题: {title} → PDF第{actual_page}页")
-                    
-                    # 简单过滤：长度和基本格式检查
-                    if 2 <= len(title) <= 40 and not any(word in title for word in ['具体而言', '根据', '.jp', '.com']):
-                        titles.append(TOCEntry(
-                            title=title,
-                            level=level,
-                            page=max(1, actual_page)
-                        ))
-            
-            return titles
+            return self._parse_items(ai_results, chunk_start_page, chunk_end_page)
         
         except json.JSONDecodeError as e:
             print(f"JSON解析错误: {e}")
@@ -208,12 +598,51 @@ class GeminiTitleExtractor:
             print(f"解析错误: {e}")
             return []
     
+    def _parse_items(self, ai_results: list, chunk_start_page: int, chunk_end_page: int) -> List[TOCEntry]:
+        """将模型返回的标题列表转换为TOCEntry，并校正页码"""
+        page_count = chunk_end_page - chunk_start_page + 1
+        log_titles = logger.isEnabledFor(logging.DEBUG)
+        
+        # 转换为TOCEntry对象
+        titles = []
+        for item in ai_results:
+            if not isinstance(item, dict) or 'title' not in item or 'level' not in item or 'page' not in item:
+                continue
+            
+            # 简单过滤：长度和基本格式检查（先过滤，被丢弃的标题不再做页码处理）
+            title = item['title'].strip()
+            if not 2 <= len(title) <= 40 or _BLACKLIST_RE.search(title):
+                continue
+            
+            # 页码处理 - 验证页码是否在合理范围内
+            raw_page = int(item['page'])
+            if chunk_start_page <= raw_page <= chunk_end_page:
+                # 页码在预期范围内，直接使用
+                actual_page = raw_page
+            elif 1 <= raw_page <= page_count:
+                # 页码是相对的，需要转换为绝对页码
+                actual_page = raw_page + chunk_start_page - 1
+                logger.info("🔧 页码调整: %s 从相对页码 %s 调整为绝对页码 %s", title, raw_page, actual_page)
+            else:
+                # 页码异常，使用默认值
+                actual_page = chunk_start_page
+                logger.warning("⚠️  页码异常: %s 原页码 %s，使用默认页码 %s", title, raw_page, actual_page)
+            
+            if log_titles:
+                logger.debug("📍 标题: %s → PDF第%s页", title, actual_page)
+            
+            titles.append(TOCEntry(
+                title=title,
+                level=min(int(item['level']), 3),  # 限制到3级
+                page=max(1, actual_page)
+            ))
+        
+        return titles
+    
     def _fallback_text_extraction(self, pdf_bytes: bytes, chunk_start_page: int) -> List[TOCEntry]:
         """回退到文本提取方式"""
         try:
-            from pdf_chunker import PDFChunker
-            chunker = PDFChunker()
-            text = chunker.extract_text_from_chunk(pdf_bytes)
+            text = self._text_chunker.extract_text_from_chunk(pdf_bytes)
             return self.extract_titles_from_text(text, chunk_start_page)
         except Exception as e:
             print(f"文本提取回退也失败: {e}")
@@ -252,17 +681,12 @@ class GeminiTitleExtractor:
 """
             
             # 使用文本处理
-            response = self.client.models.generate_content(
-                model="gemini-2.5-flash",
+            response = self._generate_content(
                 contents=[prompt],
-                config=types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    response_mime_type="application/json",
-                    response_schema={"type": "array", "items": {"type": "object", "properties": {"title": {"type": "string"}, "level": {"type": "integer"}, "page": {"type": "integer"}}, "required": ["title", "level", "page"]}}
-                )
+                estimated_tokens=len(prompt)
             )
             
-            return self._parse_response(response.text, chunk_start_page, chunk_end_page or chunk_start_page + 100, text)
+            return self._parse_response(response.text, chunk_start_page, chunk_end_page or chunk_start_page + 100)
             
         except Exception as e:
             print(f"文本标题提取过程中发生错误: {e}")
@@ -0,0 +1,42 @@
+"""
+JSON 读写工具 - 安装了 orjson 时使用它加速解析和序列化，否则回退到标准库 json
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """
+    解析JSON文本
+
+    Args:
+        data: JSON字符串或字节串
+
+    Returns:
+        解析后的Python对象
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_to_file(obj, path: str) -> None:
+    """
+    将对象以缩进格式写入JSON文件（UTF-8，不转义非ASCII字符）
+
+    Args:
+        obj: 要保存的对象
+        path: 输出文件路径
+    """
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        return
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
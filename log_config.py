@@ -0,0 +1,50 @@
+"""
+日志配置 - 日志记录经队列交给单独的后台线程写出，工作线程不会因等待终端输出而阻塞
+"""
+
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+
+_listener = None
+
+# 根日志级别对这些第三方日志记录器不生效
+_QUIET_LOGGERS = ('httpx', 'httpcore', 'google_genai', 'google.genai', 'urllib3')
+
+
+def setup_logging(verbose: bool = False) -> None:
+    """
+    配置根日志记录器（由命令行和Web入口调用一次）
+
+    Args:
+        verbose: 是否输出调试信息（如每个提取到的标题）
+    """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+    # 第三方库（每次请求的HTTP日志、SDK提示等）只输出警告及以上
+    for name in _QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = QueueListener(log_queue, handler)
+    _listener.start()
+
+
+@atexit.register
+def _stop_listener():
+    """退出前写出队列中剩余的日志"""
+    if _listener is not None:
+        _listener.stop()
@@ -22,6 +22,7 @@ Gemini PDF Indexer - 使用 Gemini 2.5 Flash 自动提取PDF标题并创建目
 import argparse
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from pathlib import Path
 from tqdm import tqdm
 from dotenv import load_dotenv
@@ -30,6 +31,7 @@ from pdf_chunker import PDFChunker
 from gemini_extractor import GeminiTitleExtractor
 from toc_merger import TOCMerger
 from pdf_toc_writer import PDFTOCWriter
+from log_config import setup_logging
 
 
 def process_single_file(args):
@@ -56,23 +58,25 @@ def process_single_file(args):
         # 步骤1: 分析PDF文件
         print("📊 分析PDF文件...")
         chunker = PDFChunker(max_pages=args.max_pages)
-        total_pages, estimated_size = chunker.get_pdf_info(str(input_path))
+        doc = chunker.open_pdf(str(input_path))
+        total_pages, file_size = chunker.get_pdf_info(doc)
         
         print(f"   总页数: {total_pages}")
-        print(f"   估算大小: {estimated_size:,} 字符")
-        print(f"   将分为 {(total_pages + args.max_pages - 1) // args.max_pages} 个处理块")
+        print(f"   文件大小: {file_size:,} 字节")
+        num_chunks = chunker.chunk_count(total_pages)
+        print(f"   将分为 {num_chunks} 个处理块")
         print()
         
-        # 步骤2: 分块处理
+        # 步骤2: 分块处理（后台线程逐块生成，与提取标题重叠进行）
         print("📦 分块读取PDF...")
-        chunks = chunker.chunk_pdf(str(input_path))
-        print(f"   已创建 {len(chunks)} 个处理块")
+        chunks = chunker.iter_chunks_prefetched(doc)
+        print(f"   按需读取 {num_chunks} 个处理块")
         print()
         
         # 步骤3: 初始化Gemini提取器
         print("🤖 初始化Gemini AI...")
         try:
-            extractor = GeminiTitleExtractor(api_key=args.api_key)
+            extractor = GeminiTitleExtractor(api_key=args.api_key, use_cache=not args.no_cache)
             print("   Gemini 2.5 Flash 已就绪")
         except ValueError as e:
             print(f"   错误: {e}")
@@ -80,36 +84,61 @@ def process_single_file(args):
             sys.exit(1)
         print()
         
-        # 步骤4: 提取标题
+        # 步骤4: 提取标题（各块相互独立，并发调用 Gemini；请求速率由提取器内的限流器控制）
         print("🔍 提取文档标题结构...")
-        all_toc_entries = []
         
-        with tqdm(total=len(chunks), desc="处理进度") as pbar:
-            for i, (chunk_bytes, start_page, end_page) in enumerate(chunks):
-                pbar.set_description(f"处理第 {start_page}-{end_page} 页")
-                
+        def process_chunk(i, chunk_bytes, start_page, end_page):
+            """提取单个块的标题，返回 (块序号, 标题列表)"""
+            if args.verbose:
+                print(f"\n   块 {i+1}/{num_chunks}: 第 {start_page}-{end_page} 页")
+            
+            # 尝试直接处理PDF字节流，如果失败则回退到文本提取
+            try:
+                toc_entries = extractor.extract_titles_from_pdf_bytes(
+                    chunk_bytes, start_page, end_page
+                )
+            except Exception as e:
                 if args.verbose:
-                    print(f"\n   块 {i+1}/{len(chunks)}: 第 {start_page}-{end_page} 页")
+                    print(f"   PDF直接处理失败，回退到文本提取: {e}")
                 
-                # 尝试直接处理PDF字节流，如果失败则回退到文本提取
-                try:
-                    toc_entries = extractor.extract_titles_from_pdf_bytes(
-                        chunk_bytes, start_page, end_page
-                    )
-                except Exception as e:
-                    if args.verbose:
-                        print(f"   PDF直接处理失败，回退到文本提取: {e}")
-                    
-                    # 回退到文本提取
-                    text = chunker.extract_text_from_chunk(chunk_bytes)
-                    toc_entries = extractor.extract_titles_from_text(text, start_page, end_page)
+                # 回退到文本提取
+                text = chunker.extract_text_from_chunk(chunk_bytes)
+                toc_entries = extractor.extract_titles_from_text(text, start_page, end_page)
+            
+            if args.verbose and toc_entries:
+                print(f"   块 {i+1} 提取到 {len(toc_entries)} 个标题")
+            
+            return i, toc_entries
+        
+        chunk_workers = max(1, args.chunk_workers)
+        results = {}
+        with tqdm(total=num_chunks, desc="处理进度") as pbar:
+            with ThreadPoolExecutor(max_workers=chunk_workers) as executor:
+                pending = {}
                 
-                all_toc_entries.append(toc_entries)
+                def collect(done):
+                    """记录已完成块的结果并更新进度"""
+                    for future in done:
+                        start_page, end_page = pending.pop(future)
+                        i, toc_entries = future.result()
+                        results[i] = toc_entries
+                        pbar.set_description(f"完成第 {start_page}-{end_page} 页")
+                        pbar.update(1)
                 
-                if args.verbose and toc_entries:
-                    print(f"   提取到 {len(toc_entries)} 个标题")
+                # 边读边提交：最多 chunk_workers 个块在处理中，后台线程另外提前准备好后续的少量块
+                for i, (chunk_bytes, start_page, end_page) in enumerate(chunks):
+                    if len(pending) >= chunk_workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    
+                    future = executor.submit(process_chunk, i, chunk_bytes, start_page, end_page)
+                    pending[future] = (start_page, end_page)
                 
-                pbar.update(1)
+                collect(as_completed(list(pending)))
+        
+        # 按块的原始顺序排列结果
+        all_toc_entries = [results[i] for i in range(len(results))]
+        doc.close()
         
         print()
         
@@ -194,7 +223,10 @@ def process_batch(args):
         # 创建处理器
         processor = BatchPDFProcessor(
             api_key=args.api_key,
-            max_pages=args.max_pages
+            max_pages=args.max_pages,
+            max_workers=args.workers,
+            chunk_workers=args.chunk_workers,
+            use_cache=not args.no_cache
         )
         
         # 开始批量处理
@@ -248,16 +280,21 @@ def main():
     parser.add_argument('--no-backup', action='store_true', help='不创建备份文件')
     parser.add_argument('--save-json', help='将提取的目录保存为JSON文件')
     parser.add_argument('--preview-only', action='store_true', help='仅预览提取的目录，不写入PDF（仅单文件模式）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用目录结果缓存，总是重新调用Gemini')
+    parser.add_argument('--chunk-workers', type=int, default=4, help='单个文件内同时提取的最大块数（默认4）')
     parser.add_argument('--verbose', '-v', action='store_true', help='显示详细信息')
     
     # 批量处理相关参数
     parser.add_argument('--batch', action='store_true', help='批量处理模式（处理文件夹中的所有PDF）')
     parser.add_argument('--recursive', '-r', action='store_true', help='递归处理子文件夹（批量模式）')
     parser.add_argument('--no-skip', action='store_true', help='不跳过已处理的文件（批量模式）')
-    parser.add_argument('--delay', type=float, default=1.0, help='文件间处理延迟秒数（批量模式，默认1秒）')
+    parser.add_argument('--delay', type=float, default=1.0, help='相邻文件开始处理的初始间隔秒数（批量模式，默认1秒，运行中自适应调整）')
+    parser.add_argument('--workers', '-w', type=int, default=4, help='同时处理的最大文件数（批量模式，默认4）')
     
     args = parser.parse_args()
     
+    setup_logging(verbose=args.verbose)
+    
     # 检查输入路径
     input_path = Path(args.input)
     if not input_path.exists():
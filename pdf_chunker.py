@@ -1,16 +1,30 @@
 import fitz  # PyMuPDF
 import math
 import io
-from typing import List, Dict, Tuple, Optional
+import os
+import queue
+import threading
+from typing import Iterator, List, Dict, Tuple, Optional, Union
 from dataclasses import dataclass
 
 
-@dataclass
+# 后台分块结束的标记
+_CHUNKS_DONE = object()
+
+
+@dataclass(frozen=True)
 class TOCEntry:
-    """目录条目数据类"""
+    """目录条目数据类（不可变；使用 __slots__，实例没有 __dict__）"""
+    __slots__ = ('title', 'level', 'page')
+    
     title: str
     level: int
     page: int
+    
+    def __reduce__(self):
+        # 不可变且带 __slots__ 的 dataclass 无法用默认方式反序列化（会逐个 setattr），
+        # 按构造参数序列化，以便传给写入进程池
+        return (TOCEntry, (self.title, self.level, self.page))
 
 
 class PDFChunker:
@@ -19,71 +33,153 @@ class PDFChunker:
     def __init__(self, max_pages: int = 1000):
         self.max_pages = max_pages
     
-    def get_pdf_info(self, pdf_path: str) -> Tuple[int, int]:
-        """获取PDF文件信息：页数和总大小"""
-        doc = fitz.open(pdf_path)
-        total_pages = len(doc)
-        
-        # 估算总大小（基于前几页的字符数）
-        sample_pages = min(5, total_pages)
-        sample_size = 0
+    def open_pdf(self, pdf_path: str) -> fitz.Document:
+        """打开PDF文件，供 get_pdf_info 和 iter_chunks 共用同一个文档对象"""
+        return fitz.open(pdf_path)
+    
+    def get_pdf_info(self, pdf: Union[str, fitz.Document]) -> Tuple[int, int]:
+        """
+        获取PDF文件信息：页数和文件大小（字节）
         
-        for i in range(sample_pages):
-            page = doc.load_page(i)
-            text = page.get_text()
-            sample_size += len(text)
+        Args:
+            pdf: PDF文件路径，或已用 open_pdf 打开的文档（不会被关闭）
+            
+        Returns:
+            Tuple[int, int]: (总页数, 文件字节数)
+        """
+        if isinstance(pdf, fitz.Document):
+            return len(pdf), self._file_size(pdf.name)
         
+        doc = self.open_pdf(pdf)
+        total_pages = len(doc)
         doc.close()
         
-        # 估算总字符数
-        estimated_total_size = (sample_size // sample_pages) * total_pages if sample_pages > 0 else 0
-        
-        return total_pages, estimated_total_size
+        return total_pages, self._file_size(pdf)
     
-    def chunk_pdf(self, pdf_path: str) -> List[Tuple[bytes, int, int]]:
+    def _file_size(self, pdf_path: str) -> int:
+        """文件字节数，无法获取时返回0（如从内存打开的文档）"""
+        try:
+            return os.path.getsize(pdf_path) if pdf_path else 0
+        except OSError:
+            return 0
+    
+    def chunk_count(self, total_pages: int) -> int:
+        """按 max_pages 计算页数为 total_pages 的文档会分成几个块"""
+        return math.ceil(total_pages / self.max_pages)
+    
+    def chunk_pdf(self, pdf_path: str) -> Iterator[Tuple[bytes, int, int]]:
         """
-        将PDF文件分块
+        将PDF文件分块（生成器，逐块产出，内存中同时只保留当前块）
         
         Args:
             pdf_path: PDF文件路径
             
-        Returns:
-            List of tuples: (pdf_bytes, start_page, end_page)
+        Yields:
+            Tuple: (pdf_bytes, start_page, end_page)
+            
+            每个块的字节只生成一次，之后按引用传给 GeminiTitleExtractor（内联请求和 File API 上传共用同一对象）
         """
-        total_pages, _ = self.get_pdf_info(pdf_path)
-        chunks = []
+        doc = self.open_pdf(pdf_path)
+        try:
+            yield from self.iter_chunks(doc)
+        finally:
+            doc.close()
+    
+    def iter_chunks(self, doc: fitz.Document) -> Iterator[Tuple[bytes, int, int]]:
+        """
+        对已打开的文档逐块产出 (pdf_bytes, start_page, end_page)，文档由调用方负责关闭
         
-        # 计算需要的块数
-        num_chunks = math.ceil(total_pages / self.max_pages)
+        Args:
+            doc: 已打开的PDF文档
+            
+        Yields:
+            Tuple: (pdf_bytes, start_page, end_page)
+        """
+        total_pages = len(doc)
+        num_chunks = self.chunk_count(total_pages)
         
-        doc = fitz.open(pdf_path)
+        # 整个文档只有一个块时直接读取原文件字节：
+        # 跳过 insert_pdf + tobytes 的完整复制和重新序列化
+        # （加密文档仍需经 PyMuPDF 重新生成未加密的副本）
+        if num_chunks == 1 and doc.name and not doc.metadata.get('encryption'):
+            with open(doc.name, 'rb') as f:
+                yield f.read(), 1, total_pages
+            return
         
         for i in range(num_chunks):
             start_page = i * self.max_pages
             end_page = min((i + 1) * self.max_pages, total_pages)
             
-            # 创建新文档包含指定页面范围
+            # 创建新文档包含指定页面范围（不复制链接：块只用于提取标题，
+            # 省去逐页解析和重建链接目标的开销）
             chunk_doc = fitz.open()
-            chunk_doc.insert_pdf(doc, from_page=start_page, to_page=end_page - 1)
+            chunk_doc.insert_pdf(doc, from_page=start_page, to_page=end_page - 1, links=False)
             
             # 转换为字节流
             chunk_bytes = chunk_doc.tobytes()
-            chunks.append((chunk_bytes, start_page + 1, end_page))  # 页码从1开始
-            
             chunk_doc.close()
+            
+            yield chunk_bytes, start_page + 1, end_page  # 页码从1开始
+    
+    def iter_chunks_prefetched(self, doc: fitz.Document, prefetch: int = 2) -> Iterator[Tuple[bytes, int, int]]:
+        """
+        与 iter_chunks 相同，但在后台线程中提前生成最多 prefetch 个块
         
-        doc.close()
-        return chunks
+        分块（本地I/O和序列化）与调用方对块的处理（如 Gemini 请求）重叠进行；
+        队列有上限，处理较慢时生成线程会等待，内存中只多保留 prefetch 个块。
+        迭代期间调用方不要使用 doc。
+        
+        Args:
+            doc: 已打开的PDF文档
+            prefetch: 预先生成的块数上限
+            
+        Yields:
+            Tuple: (pdf_bytes, start_page, end_page)
+        """
+        chunk_queue = queue.Queue(maxsize=max(1, prefetch))
+        stop = threading.Event()
+        
+        def produce():
+            try:
+                for chunk in self.iter_chunks(doc):
+                    if stop.is_set():
+                        return
+                    chunk_queue.put(chunk)
+            except Exception as e:
+                chunk_queue.put(e)
+            finally:
+                chunk_queue.put(_CHUNKS_DONE)
+        
+        producer = threading.Thread(target=produce, name='pdf-chunk-producer', daemon=True)
+        producer.start()
+        
+        try:
+            while True:
+                item = chunk_queue.get()
+                if item is _CHUNKS_DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # 调用方提前结束迭代时通知生成线程停止，并取走队列中的块使其不再阻塞；
+            # 返回前确保生成线程已退出，调用方随后可以安全关闭文档
+            stop.set()
+            while producer.is_alive():
+                try:
+                    chunk_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
     
     def extract_text_from_chunk(self, chunk_bytes: bytes) -> str:
         """从PDF块中提取文本"""
         doc = fitz.open(stream=chunk_bytes, filetype="pdf")
-        text = ""
+        parts = []
         
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            text += f"\n--- 第 {page_num + 1} 页 ---\n"
-            text += page.get_text()
+        # 逐页收集后一次拼接，避免反复拼接长字符串
+        for page_num, page in enumerate(doc):
+            parts.append(f"\n--- 第 {page_num + 1} 页 ---\n")
+            parts.append(page.get_text())
         
         doc.close()
-        return text
\ No newline at end of file
+        return "".join(parts)
@@ -1,15 +1,30 @@
 import fitz  # PyMuPDF
 import os
 import shutil
-from typing import List
+from typing import BinaryIO, List
 from pdf_chunker import TOCEntry
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Linux ioctl：让目标文件共享源文件的数据块（写时复制克隆）
+FICLONE = 0x40049409
+
 
 class PDFTOCWriter:
     """PDF目录写入器"""
     
-    def __init__(self):
-        pass
+    def __init__(self, save_level: int = 1):
+        """
+        初始化写入器
+        
+        Args:
+            save_level: 另存为新文件时的整理程度（0-4，对应 PyMuPDF 的 garbage 参数）。
+                默认1只移除无用对象，只改目录时保存最快；3及以上同时重新压缩数据流，文件更小但更慢
+        """
+        self.save_level = save_level
     
     def write_toc_to_pdf(self, pdf_path: str, toc_entries: List[TOCEntry], output_path: str = None, backup: bool = True) -> str:
         """
@@ -34,18 +49,7 @@ class PDFTOCWriter:
             print(f"原文件已备份到: {backup_path}")
         
         try:
-            # 打开PDF文档
-            doc = fitz.open(pdf_path)
-            
-            # 转换目录格式
-            toc_list = self._convert_to_pymupdf_format(toc_entries)
-            
-            # 验证目录格式
-            if not self._validate_toc_format(toc_list, len(doc)):
-                raise ValueError("目录格式验证失败")
-            
-            # 设置目录
-            doc.set_toc(toc_list)
+            doc = self._open_with_toc(pdf_path, toc_entries)
             
             # 保存文档（增量保存以保持原有内容）
             if output_path == pdf_path:
@@ -53,7 +57,7 @@ class PDFTOCWriter:
                 doc.saveIncr()
             else:
                 # 保存到新文件
-                doc.save(output_path, garbage=3, deflate=True)
+                doc.save(output_path, garbage=self.save_level, deflate=self.save_level >= 3, clean=False)
             
             doc.close()
             
@@ -66,6 +70,48 @@ class PDFTOCWriter:
             print(f"写入目录时发生错误: {e}")
             raise
     
+    def write_toc_to_stream(self, pdf_path: str, toc_entries: List[TOCEntry], out_stream: BinaryIO) -> None:
+        """
+        将带目录的PDF写入文件对象（如 BytesIO），不在磁盘上生成输出文件
+        
+        Args:
+            pdf_path: 源PDF文件路径
+            toc_entries: 目录条目列表
+            out_stream: 可写的二进制文件对象
+        """
+        doc = self._open_with_toc(pdf_path, toc_entries)
+        try:
+            doc.save(out_stream, garbage=self.save_level, deflate=self.save_level >= 3, clean=False)
+        finally:
+            doc.close()
+    
+    def _open_with_toc(self, pdf_path: str, toc_entries: List[TOCEntry]) -> fitz.Document:
+        """
+        打开PDF并设置目录（调用方负责保存和关闭文档）
+        
+        Args:
+            pdf_path: 源PDF文件路径
+            toc_entries: 目录条目列表
+            
+        Returns:
+            fitz.Document: 已设置目录的文档
+        """
+        doc = fitz.open(pdf_path)
+        try:
+            # 转换目录格式
+            toc_list = self._convert_to_pymupdf_format(toc_entries)
+            
+            # 验证目录格式
+            if not self._validate_toc_format(toc_list, len(doc)):
+                raise ValueError("目录格式验证失败")
+            
+            # 设置目录
+            doc.set_toc(toc_list)
+        except Exception:
+            doc.close()
+            raise
+        return doc
+    
     def _create_backup(self, pdf_path: str) -> str:
         """
         创建文件备份
@@ -85,31 +131,56 @@ class PDFTOCWriter:
             backup_path = f"{base_name}_backup_{counter}.pdf"
             counter += 1
         
-        shutil.copy2(pdf_path, backup_path)
+        # 优先用写时复制克隆（btrfs、XFS 等），不实际复制数据；不支持时完整复制。
+        # 不使用硬链接：原地处理时 saveIncr 会直接追加写入原文件，硬链接的备份会被一起修改
+        if not self._clone_file(pdf_path, backup_path):
+            shutil.copy2(pdf_path, backup_path)
         return backup_path
     
-    def _convert_to_pymupdf_format(self, toc_entries: List[TOCEntry]) -> List[List]:
+    def _clone_file(self, src_path: str, dst_path: str) -> bool:
         """
-        转换为PyMuPDF需要的目录格式
+        通过 FICLONE 创建写时复制的文件副本
         
         Args:
-            toc_entries: 目录条目列表
+            src_path: 源文件路径
+            dst_path: 目标文件路径（不能已存在）
             
         Returns:
-            List[List]: PyMuPDF格式的目录
+            bool: 是否克隆成功，失败时不会留下目标文件
         """
-        toc_list = []
+        if fcntl is None:
+            return False
+        
+        try:
+            with open(src_path, 'rb') as src, open(dst_path, 'xb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                except OSError:
+                    cloned = False
+                else:
+                    cloned = True
+        except OSError:
+            return False
         
-        for entry in toc_entries:
-            # PyMuPDF格式：[level, title, page]
-            toc_item = [
-                entry.level,
-                entry.title,
-                entry.page
-            ]
-            toc_list.append(toc_item)
+        if not cloned:
+            os.unlink(dst_path)
+            return False
         
-        return toc_list
+        shutil.copystat(src_path, dst_path)
+        return True
+    
+    @staticmethod
+    def _convert_to_pymupdf_format(toc_entries: List[TOCEntry]) -> List[List]:
+        """
+        转换为PyMuPDF需要的目录格式
+        
+        Args:
+            toc_entries: 目录条目列表
+            
+        Returns:
+            List[List]: PyMuPDF格式的目录，每项为 [level, title, page]
+        """
+        return [[entry.level, entry.title, entry.page] for entry in toc_entries]
     
     def _validate_toc_format(self, toc_list: List[List], total_pages: int) -> bool:
         """
@@ -122,6 +193,17 @@ class PDFTOCWriter:
         Returns:
             bool: 验证是否通过
         """
+        # 快速路径：条目通常都合规，先用一个生成器表达式整体确认，发现问题再逐项检查并给出详细信息
+        try:
+            if all(
+                type(level) is int and type(page) is int and type(title) is str
+                and 1 <= level <= 10 and 1 <= page <= total_pages and title.strip()
+                for level, title, page in toc_list
+            ):
+                return True
+        except (TypeError, ValueError):
+            pass
+        
         for item in toc_list:
             # 检查格式
             if not isinstance(item, list) or len(item) < 3:
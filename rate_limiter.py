@@ -0,0 +1,73 @@
+import threading
+import time
+from typing import Optional
+
+
+class RateLimiter:
+    """线程安全的令牌桶限流器，同时限制每分钟请求数（RPM）和每分钟 token 数（TPM）"""
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        """
+        初始化限流器
+
+        Args:
+            rpm: 每分钟最大请求数，None 或 0 表示不限制
+            tpm: 每分钟最大 token 数，None 或 0 表示不限制
+        """
+        self.rpm = rpm or 0
+        self.tpm = tpm or 0
+
+        # 令牌桶初始为满，允许启动时的一次突发
+        self._request_tokens = float(self.rpm)
+        self._token_tokens = float(self.tpm)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        阻塞直到配额允许发起一次请求
+
+        Args:
+            tokens: 本次请求预计消耗的 token 数
+
+        Returns:
+            float: 实际等待的秒数
+        """
+        if not self.rpm and not self.tpm:
+            return 0.0
+
+        # 单次请求超过整个桶容量时按满桶计算，避免永久等待
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+
+                wait = 0.0
+                if self.rpm and self._request_tokens < 1:
+                    wait = max(wait, (1 - self._request_tokens) * 60.0 / self.rpm)
+                if self.tpm and self._token_tokens < tokens:
+                    wait = max(wait, (tokens - self._token_tokens) * 60.0 / self.tpm)
+
+                if wait <= 0:
+                    if self.rpm:
+                        self._request_tokens -= 1
+                    if self.tpm:
+                        self._token_tokens -= tokens
+                    return waited
+
+            time.sleep(wait)
+            waited += wait
+
+    def _refill(self):
+        """按经过的时间补充令牌（调用方需持有锁）"""
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+
+        if self.rpm:
+            self._request_tokens = min(self.rpm, self._request_tokens + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._token_tokens = min(self.tpm, self._token_tokens + elapsed * self.tpm / 60.0)
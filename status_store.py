@@ -0,0 +1,214 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+
+# 任务状态保留时长（秒），超过后在创建新任务时清除
+STATUS_TTL = 24 * 3600
+
+
+class StatusStore:
+    """进程内的任务状态存储，每次更新递增版本号，供长轮询等待变化"""
+
+    # 状态只在本进程可见
+    shared = False
+
+    def __init__(self):
+        self._tasks = {}
+        self._updated = {}  # {任务ID: 最后更新时间}，用于清除过期任务
+        self._changed = threading.Condition()
+
+    def create(self, task_id: str, fields: Dict) -> None:
+        """
+        创建任务状态，同时清除过期任务
+
+        Args:
+            task_id: 任务ID
+            fields: 初始状态字段
+        """
+        now = time.time()
+        with self._changed:
+            expired = [key for key, updated in self._updated.items() if updated < now - STATUS_TTL]
+            for key in expired:
+                self._tasks.pop(key, None)
+                self._updated.pop(key, None)
+            self._tasks[task_id] = dict(fields, version=0)
+            self._updated[task_id] = now
+            self._changed.notify_all()
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        """
+        读取任务状态快照
+
+        Returns:
+            Optional[Dict]: 状态字典的副本，任务不存在时返回 None
+        """
+        with self._changed:
+            status = self._tasks.get(task_id)
+            return dict(status) if status is not None else None
+
+    def update(self, task_id: str, fields: Dict) -> None:
+        """
+        更新任务状态并唤醒等待者，任务已被删除时忽略
+
+        Args:
+            task_id: 任务ID
+            fields: 要更新的字段
+        """
+        with self._changed:
+            status = self._tasks.get(task_id)
+            if status is None:
+                return
+            status.update(fields)
+            status['version'] += 1
+            self._updated[task_id] = time.time()
+            self._changed.notify_all()
+
+    def delete(self, task_id: str) -> Optional[Dict]:
+        """
+        删除任务状态
+
+        Returns:
+            Optional[Dict]: 被删除的状态，任务不存在时返回 None
+        """
+        with self._changed:
+            status = self._tasks.pop(task_id, None)
+            self._updated.pop(task_id, None)
+            self._changed.notify_all()
+            return status
+
+    def wait_for_change(self, task_id: str, since: int, timeout: float) -> Optional[Dict]:
+        """
+        阻塞直到任务版本号不再等于 since、任务结束或超时
+
+        Args:
+            task_id: 任务ID
+            since: 调用方已知的版本号
+            timeout: 最长等待秒数
+
+        Returns:
+            Optional[Dict]: 最新状态，任务不存在时返回 None
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                status = self._tasks.get(task_id)
+                if status is None or _settled(status, since):
+                    return dict(status) if status is not None else None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return dict(status)
+                self._changed.wait(remaining)
+
+
+class SQLiteStatusStore:
+    """
+    基于 SQLite（WAL 模式）的任务状态存储，供同一主机上的多个 Web 工作进程共享
+
+    跨进程无法直接通知，wait_for_change 以较短间隔检查版本号
+    """
+
+    POLL_INTERVAL = 0.5
+
+    # 状态在多个进程间共享，后续请求可能由其他进程处理
+    shared = True
+
+    def __init__(self, db_path: str):
+        """
+        初始化数据库
+
+        Args:
+            db_path: SQLite 数据库文件路径
+        """
+        self.db_path = os.path.expanduser(db_path)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'task_id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                'version INTEGER NOT NULL, updated REAL NOT NULL)'
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        """每个线程使用独立连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def create(self, task_id: str, fields: Dict) -> None:
+        """创建任务状态，同时清除过期任务"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('DELETE FROM tasks WHERE updated < ?', (now - STATUS_TTL,))
+            conn.execute(
+                'INSERT OR REPLACE INTO tasks (task_id, data, version, updated) VALUES (?, ?, 0, ?)',
+                (task_id, json.dumps(fields, ensure_ascii=False), now)
+            )
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        """读取任务状态，任务不存在时返回 None"""
+        row = self._connect().execute(
+            'SELECT data, version FROM tasks WHERE task_id = ?', (task_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        status = json.loads(row[0])
+        status['version'] = row[1]
+        return status
+
+    def update(self, task_id: str, fields: Dict) -> None:
+        """更新任务状态（读-改-写在同一个写事务中完成），任务已被删除时忽略"""
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                return
+            status = json.loads(row[0])
+            status.update(fields)
+            conn.execute(
+                'UPDATE tasks SET data = ?, version = version + 1, updated = ? WHERE task_id = ?',
+                (json.dumps(status, ensure_ascii=False), time.time(), task_id)
+            )
+
+    def delete(self, task_id: str) -> Optional[Dict]:
+        """删除任务状态，返回被删除的状态"""
+        status = self.get(task_id)
+        if status is not None:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+        return status
+
+    def wait_for_change(self, task_id: str, since: int, timeout: float) -> Optional[Dict]:
+        """阻塞直到任务版本号不再等于 since、任务结束或超时"""
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.get(task_id)
+            if status is None or _settled(status, since):
+                return status
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return status
+            time.sleep(min(self.POLL_INTERVAL, remaining))
+
+
+def _settled(status: Dict, since: int) -> bool:
+    """状态已不同于调用方所知的版本，或任务已结束"""
+    return status['version'] != since or status['status'] in ('completed', 'error')
+
+
+def create_status_store():
+    """
+    按环境变量选择状态存储：设置了 GEMINI_STATUS_DB 时使用该路径的 SQLite 数据库，否则使用进程内存储
+    """
+    db_path = os.getenv('GEMINI_STATUS_DB')
+    if db_path:
+        return SQLiteStatusStore(db_path)
+    return StatusStore()
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import tempfile
+import threading
+from dataclasses import asdict
+from typing import List, Optional
+from pdf_chunker import TOCEntry
+import json_utils
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.gemini_toc_cache')
+
+
+def content_hash(data: bytes) -> str:
+    """计算内容哈希（BLAKE2b），用作缓存键"""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def file_hash(path: str, block_size: int = 1 << 20) -> str:
+    """分块读取文件计算内容哈希，与 content_hash 结果一致，不把整个文件读入内存"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class TOCCache:
+    """按内容哈希寻址的目录结果磁盘缓存"""
+
+    def __init__(self, cache_dir: Optional[str] = None, max_entries: Optional[int] = None):
+        """
+        初始化缓存目录
+
+        Args:
+            cache_dir: 缓存目录，None 则使用环境变量 GEMINI_TOC_CACHE_DIR 或 ~/.gemini_toc_cache
+            max_entries: 保留的最大条目数，None 表示不限制；打开时及之后每写入约十分之一该数量的条目时按最近使用淘汰
+        """
+        if cache_dir is None:
+            cache_dir = os.getenv('GEMINI_TOC_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.max_entries = max_entries
+        self._writes_since_prune = 0
+        self._prune_lock = threading.Lock()
+        if max_entries:
+            self.prune(max_entries)
+
+    def get(self, key: str) -> Optional[List[TOCEntry]]:
+        """
+        读取缓存的目录条目
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            Optional[List[TOCEntry]]: 命中时返回目录条目，未命中返回 None
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = json_utils.loads(f.read())
+            entries = [TOCEntry(**item) for item in data]
+        except (OSError, ValueError, TypeError):
+            return None
+
+        # 刷新修改时间，供 prune 按最近使用淘汰（atime 在 noatime/relatime 挂载下不可靠）
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entries
+
+    def set(self, key: str, entries: List[TOCEntry]) -> None:
+        """
+        写入目录条目（先写临时文件再原子替换，避免并发读到半个文件）
+
+        Args:
+            key: 缓存键
+            entries: 目录条目列表
+        """
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            os.close(fd)
+            json_utils.dump_to_file([asdict(entry) for entry in entries], tmp_path)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"写入目录缓存失败: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+
+        if self.max_entries:
+            with self._prune_lock:
+                self._writes_since_prune += 1
+                due = self._writes_since_prune >= max(1, self.max_entries // 10)
+                if due:
+                    self._writes_since_prune = 0
+            if due:
+                self.prune(self.max_entries)
+
+    def prune(self, max_entries: int) -> int:
+        """
+        按最近使用时间淘汰最旧的条目，只保留 max_entries 个
+
+        Args:
+            max_entries: 保留的最大条目数
+
+        Returns:
+            int: 删除的条目数
+        """
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((max(st.st_atime, st.st_mtime), entry.path))
+
+        excess = len(entries) - max_entries
+        if excess <= 0:
+            return 0
+
+        entries.sort()
+        removed = 0
+        for _, path in entries[:excess]:
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _path(self, key: str) -> str:
+        """缓存键对应的文件路径"""
+        return os.path.join(self.cache_dir, f"{key}.json")
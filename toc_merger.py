@@ -1,7 +1,162 @@
-from typing import List
+from collections import defaultdict
+from difflib import SequenceMatcher
+from functools import lru_cache
+from operator import attrgetter
+from typing import List, NamedTuple, Optional
 from pdf_chunker import TOCEntry
+import heapq
+import json_utils
 import re
 
+try:
+    from rapidfuzz import fuzz
+except ImportError:
+    fuzz = None
+
+
+# 标题比较前去掉的编号前缀，以及除文字外的其他字符
+_NORM_NUM = re.compile(r'^[\d\.\s\(\)①②③④⑤⑥⑦⑧⑨⑩一二三四五六七八九十]+')
+_NORM_KEEP = re.compile(r'[^\w\u4e00-\u9fff]')
+
+# 按标题格式预测层级：(模式, 层级)，按顺序匹配第一个
+_LEVEL_PATS = (
+    # 一级标题模式
+    (re.compile(r'^第[一二三四五六七八九十\d]+章'), 1),
+    (re.compile(r'^[一二三四五六七八九十]\s*[、.]'), 1),
+    (re.compile(r'^\d+\s*[、.](?!\d)'), 1),
+    # 二级标题模式
+    (re.compile(r'^\d+\.\d+\s'), 2),
+    (re.compile(r'^\([一二三四五六七八九十\d]+\)'), 2),
+    (re.compile(r'^[①②③④⑤⑥⑦⑧⑨⑩]'), 2),
+    # 三级标题模式
+    (re.compile(r'^\d+\.\d+\.\d+\s'), 3),
+    (re.compile(r'^[a-zA-Z]\)'), 3),
+    (re.compile(r'^[ⅰⅱⅲⅳⅴⅵⅶⅷⅸⅹ]'), 3),
+    # 四级标题模式
+    (re.compile(r'^\d+\.\d+\.\d+\.\d+\s'), 4),
+    (re.compile(r'^[a-z]\.\s'), 4),
+)
+
+# 纯数字、日期或符号
+_NUMERIC_ONLY = re.compile(r'^[\d\s\.\-_年月日]+$')
+# 以句号、感叹号、问号结尾（可能是句子而非标题）
+_SENTENCE_END = re.compile(r'[。！？]$')
+# 句子中常见的标点符号
+_PUNCTUATION = re.compile(r'[，。；：！？""''（）]')
+
+# 明显的排除模式
+_EXCLUDE_PATTERNS = [
+    r'^图\s*\d+',
+    r'^表\s*\d+',
+    r'^Figure\s*\d+',
+    r'^Table\s*\d+',
+    r'第\s*\d+\s*页',
+    r'Page\s*\d+',
+    r'^参考文献',
+    r'^致谢',
+    r'^附录[A-Z]?$',
+    r'^\d{4}年',  # 纯年份
+    r'具体而言',   # 句子开头
+    r'根据.*',    # 句子开头
+    r'.*。.*',    # 包含句号的句子
+    r'^[a-z]+\.[a-z]+',  # 网址片段
+    r'双语优势',   # 描述性内容
+    r'语言考试替代', # 描述性内容
+    r'课程环境',   # 描述性内容
+    r'能力.*的.*', # 描述性句子模式
+    r'项目.*允许', # 描述性句子模式
+]
+
+# 明确的标题格式（从开头匹配）
+_TITLE_PATTERNS = [
+    r'^第[一二三四五六七八九十\d]+章',
+    r'^第[一二三四五六七八九十\d]+节',
+    r'^[一二三四五六七八九十]\s*[、.]',
+    r'^\d+\s*[、.]',
+    r'^\d+\.\d+',
+    r'^\([一二三四五六七八九十\d]+\)',
+    r'^[①②③④⑤⑥⑦⑧⑨⑩]',
+]
+
+# 各组模式合并为一个正则，一次扫描即可判断是否命中其中任意一个
+_EXCLUDE_UNION = re.compile('|'.join(f'(?:{pattern})' for pattern in _EXCLUDE_PATTERNS), re.IGNORECASE)
+_TITLE_UNION = re.compile('|'.join(f'(?:{pattern})' for pattern in _TITLE_PATTERNS))
+
+# 没有明确标题格式时，出现两个以上即视为描述性文字
+_DESCRIPTIVE_WORDS = ['能力', '环境', '课程', '项目', '院校', '成绩', '证明', '具备', '允许', '作为', '同时', '发展', '状况', '情况', '内容', '方面']
+
+
+@lru_cache(maxsize=8192)
+def _normalize_title(title: str) -> str:
+    """标准化标题以便比较（结果按标题缓存，去重时同一标题会被反复比较）"""
+    # 移除编号
+    title = _NORM_NUM.sub('', title)
+    # 移除特殊字符和多余空格
+    title = _NORM_KEEP.sub('', title)
+    return title.lower().strip()
+
+
+# 以下判断只依赖标题字符串，相同格式和重复标题在各块之间反复出现，按标题缓存结果
+
+@lru_cache(maxsize=4096)
+def _predict_level_from_format(title: str) -> int:
+    """基于标题格式预测层级"""
+    title = title.strip()
+    
+    for pattern, level in _LEVEL_PATS:
+        if pattern.match(title):
+            return level
+    
+    # 默认返回2级
+    return 2
+
+
+@lru_cache(maxsize=4096)
+def _is_valid_title(title: str) -> bool:
+    """判断是否为有效标题（更严格的标准）"""
+    title = title.strip()
+    
+    # 基本长度检查
+    if len(title) < 3 or len(title) > 50:
+        return False
+    
+    # 纯数字、日期或符号
+    if _NUMERIC_ONLY.match(title):
+        return False
+    
+    # 以句号、感叹号、问号结尾的（可能是句子而非标题）
+    if _SENTENCE_END.search(title):
+        return False
+    
+    # 包含过多标点符号的（可能是句子片段）
+    punctuation_count = len(_PUNCTUATION.findall(title))
+    if punctuation_count > 2:
+        return False
+    
+    # 明显的排除模式
+    if _EXCLUDE_UNION.search(title):
+        return False
+    
+    # 如果有明确的标题格式，直接通过
+    if _TITLE_UNION.match(title):
+        return True
+    
+    # 否则需要更严格的检查
+    # 不能包含太多的描述性词汇
+    descriptive_count = sum(1 for word in _DESCRIPTIVE_WORDS if word in title)
+    if descriptive_count > 1:
+        return False
+    
+    return True
+
+
+class _EnrichedEntry(NamedTuple):
+    """合并过程中的目录条目，附带只依赖标题、预先计算好的信息"""
+    entry: TOCEntry
+    norm_title: str
+    predicted_level: int
+    is_valid: bool
+
 
 class AdvancedTOCMerger:
     """高级目录合并和层级优化处理器"""
@@ -19,20 +174,30 @@ class AdvancedTOCMerger:
         Returns:
             List[TOCEntry]: 合并后的目录条目
         """
-        merged = []
-        
-        # 展开所有条目
-        for chunk_entries in all_entries:
-            merged.extend(chunk_entries)
+        # 按页码排序：各块分别排序后归并（块内条目通常已有序，排序近乎线性；
+        # 页码相同时保持块的先后顺序，与整体稳定排序的结果一致）
+        sort_key = attrgetter('page', 'level')
+        merged = list(heapq.merge(
+            *(sorted(chunk_entries, key=sort_key) for chunk_entries in all_entries),
+            key=sort_key
+        ))
         
         if not merged:
             return []
         
-        # 按页码排序
-        merged.sort(key=lambda x: (x.page, x.level))
+        # 每个条目的标准化标题、格式预测层级和有效性只依赖标题，预先计算一次供后续各步使用
+        enriched = [
+            _EnrichedEntry(
+                entry,
+                _normalize_title(entry.title),
+                _predict_level_from_format(entry.title),
+                _is_valid_title(entry.title)
+            )
+            for entry in merged
+        ]
         
         # 去重和清理
-        cleaned = self._remove_duplicates_advanced(merged)
+        cleaned = self._remove_duplicates_advanced(enriched)
         
         # 智能层级修正
         validated = self._validate_and_fix_levels_advanced(cleaned)
@@ -42,76 +207,81 @@ class AdvancedTOCMerger:
         
         return final_result
     
-    def _remove_duplicates_advanced(self, entries: List[TOCEntry]) -> List[TOCEntry]:
+    def _remove_duplicates_advanced(self, entries: List[_EnrichedEntry]) -> List[_EnrichedEntry]:
         """
         高级去重算法 - 考虑相似性和上下文
         
         Args:
-            entries: 原始目录条目列表
+            entries: 原始目录条目列表（附带预先计算的标题信息）
             
         Returns:
-            List[TOCEntry]: 去重后的目录条目
+            List[_EnrichedEntry]: 去重后的目录条目
         """
         if not entries:
             return []
         
         unique_entries = []
+        page_index = defaultdict(list)  # 页码 -> unique_entries 中的下标
         
         for current in entries:
-            is_duplicate = False
+            page = current.entry.page
+            
+            # 重复项的页码相差不超过2，只需比较附近页码上的条目（按下标顺序，保证取第一个匹配项）
+            candidates = sorted(
+                j for near_page in range(page - 2, page + 3) for j in page_index.get(near_page, ())
+            )
             
-            for i, existing in enumerate(unique_entries):
+            for j in candidates:
+                existing = unique_entries[j]
+                
                 # 检查是否为重复项
-                if self._is_duplicate_entry(current, existing):
+                if self._is_duplicate_entry(current.entry, existing.entry, current.norm_title, existing.norm_title):
                     # 选择更好的版本
-                    better_entry = self._choose_better_entry(current, existing)
-                    unique_entries[i] = better_entry
-                    is_duplicate = True
+                    if self._choose_better_entry(current.entry, existing.entry) is not existing.entry:
+                        unique_entries[j] = current
+                        if page != existing.entry.page:
+                            page_index[existing.entry.page].remove(j)
+                            page_index[page].append(j)
                     break
-            
-            if not is_duplicate:
+            else:
+                page_index[page].append(len(unique_entries))
                 unique_entries.append(current)
         
         return unique_entries
     
-    def _is_duplicate_entry(self, entry1: TOCEntry, entry2: TOCEntry) -> bool:
-        """判断两个条目是否为重复"""
+    def _is_duplicate_entry(self, entry1: TOCEntry, entry2: TOCEntry,
+                            norm1: Optional[str] = None, norm2: Optional[str] = None) -> bool:
+        """判断两个条目是否为重复（norm1/norm2 为已计算好的标准化标题，可省略）"""
         # 页码相近（±2页内）
         page_close = abs(entry1.page - entry2.page) <= 2
         
-        # 标题相似性检查
-        title_similar = self._calculate_title_similarity(entry1.title, entry2.title) > 0.8
-        
         # 层级相同或相近
         level_close = abs(entry1.level - entry2.level) <= 1
         
-        return page_close and title_similar and level_close
+        if not (page_close and level_close):
+            return False
+        
+        # 标题相似性检查
+        if norm1 is None:
+            norm1 = _normalize_title(entry1.title)
+        if norm2 is None:
+            norm2 = _normalize_title(entry2.title)
+        return self._normalized_similarity(norm1, norm2) > 0.8
     
     def _calculate_title_similarity(self, title1: str, title2: str) -> float:
         """计算标题相似性（0-1）"""
-        # 标准化标题
-        t1 = self._normalize_title(title1)
-        t2 = self._normalize_title(title2)
-        
+        return self._normalized_similarity(_normalize_title(title1), _normalize_title(title2))
+    
+    def _normalized_similarity(self, t1: str, t2: str) -> float:
+        """计算两个已标准化标题的相似性（0-1）"""
         if t1 == t2:
             return 1.0
         
-        # 计算编辑距离相似性
-        max_len = max(len(t1), len(t2))
-        if max_len == 0:
-            return 1.0
-        
-        # 简单的相似性计算
-        common_chars = sum(1 for a, b in zip(t1, t2) if a == b)
-        return common_chars / max_len
-    
-    def _normalize_title(self, title: str) -> str:
-        """标准化标题以便比较"""
-        # 移除编号
-        title = re.sub(r'^[\d\.\s\(\)①②③④⑤⑥⑦⑧⑨⑩一二三四五六七八九十]+', '', title)
-        # 移除特殊字符和多余空格
-        title = re.sub(r'[^\w\u4e00-\u9fff]', '', title)
-        return title.lower().strip()
+        # 基于编辑距离的相似度（插入/删除字符不会让后续字符全部错位）；
+        # 安装了 rapidfuzz 时使用其C++实现，否则回退到标准库 difflib
+        if fuzz is not None:
+            return fuzz.ratio(t1, t2) / 100.0
+        return SequenceMatcher(None, t1, t2).ratio()
     
     def _choose_better_entry(self, entry1: TOCEntry, entry2: TOCEntry) -> TOCEntry:
         """在重复条目中选择更好的版本"""
@@ -133,246 +303,46 @@ class AdvancedTOCMerger:
         
         return entry2
     
-    def _validate_and_fix_levels_advanced(self, entries: List[TOCEntry]) -> List[TOCEntry]:
+    def _validate_and_fix_levels_advanced(self, entries: List[_EnrichedEntry]) -> List[_EnrichedEntry]:
         """
         高级层级验证和修正算法
         
         Args:
-            entries: 目录条目列表
+            entries: 目录条目列表（附带预先计算的标题信息）
             
         Returns:
-            List[TOCEntry]: 层级修正后的目录条目
+            List[_EnrichedEntry]: 层级修正后的目录条目
         """
         if not entries:
             return entries
         
         validated = []
-        level_stack = []  # 跟踪层级栈
-        
-        for entry in entries:
-            # 分析标题格式以确定正确层级
-            predicted_level = self._predict_level_from_format(entry.title)
-            
-            # 结合上下文调整层级
-            adjusted_level = self._adjust_level_with_context(
-                entry.level, predicted_level, level_stack
-            )
-            
-            # 创建新的条目
-            new_entry = TOCEntry(
-                title=entry.title,
-                level=adjusted_level,
-                page=entry.page
-            )
-            
-            # 更新层级栈
-            self._update_level_stack(level_stack, adjusted_level)
-            
-            validated.append(new_entry)
-        
-        # 后处理：确保层级的连续性
-        return self._ensure_level_continuity(validated)
-    
-    def _predict_level_from_format(self, title: str) -> int:
-        """基于标题格式预测层级"""
-        title = title.strip()
-        
-        # 一级标题模式
-        if re.match(r'^第[一二三四五六七八九十\d]+章', title):
-            return 1
-        if re.match(r'^[一二三四五六七八九十]\s*[、.]', title):
-            return 1
-        if re.match(r'^\d+\s*[、.](?!\d)', title):
-            return 1
-        
-        # 二级标题模式
-        if re.match(r'^\d+\.\d+\s', title):
-            return 2
-        if re.match(r'^\([一二三四五六七八九十\d]+\)', title):
-            return 2
-        if re.match(r'^[①②③④⑤⑥⑦⑧⑨⑩]', title):
-            return 2
-        
-        # 三级标题模式
-        if re.match(r'^\d+\.\d+\.\d+\s', title):
-            return 3
-        if re.match(r'^[a-zA-Z]\)', title):
-            return 3
-        if re.match(r'^[ⅰⅱⅲⅳⅴⅵⅶⅷⅸⅹ]', title):
-            return 3
-        
-        # 四级标题模式
-        if re.match(r'^\d+\.\d+\.\d+\.\d+\s', title):
-            return 4
-        if re.match(r'^[a-z]\.\s', title):
-            return 4
-        
-        # 默认返回2级
-        return 2
-    
-    def _adjust_level_with_context(self, original_level: int, predicted_level: int, level_stack: List[int]) -> int:
-        """结合上下文调整层级"""
-        # 如果预测层级很明确，使用预测层级
-        if predicted_level > 0:
-            base_level = predicted_level
-        else:
-            base_level = original_level
-        
-        # 确保层级不会跳跃太大
-        if level_stack:
-            last_level = level_stack[-1]
-            if base_level > last_level + 1:
-                base_level = last_level + 1
-        
-        # 确保层级至少为1
-        return max(1, base_level)
-    
-    def _update_level_stack(self, level_stack: List[int], current_level: int):
-        """更新层级栈"""
-        # 移除比当前层级更深的层级
-        while level_stack and level_stack[-1] >= current_level:
-            level_stack.pop()
-        
-        # 添加当前层级
-        level_stack.append(current_level)
-    
-    def _ensure_level_continuity(self, entries: List[TOCEntry]) -> List[TOCEntry]:
-        """确保层级的连续性"""
-        if not entries:
-            return entries
-        
-        result = []
         last_level = 0
         
-        for entry in entries:
-            current_level = entry.level
-            
-            # 确保层级不会跳跃太大
-            if current_level > last_level + 1:
-                current_level = last_level + 1
+        for item in entries:
+            entry = item.entry
             
-            # 确保层级至少为1
-            current_level = max(1, current_level)
+            # 结合上下文调整基于标题格式预测的层级：不能比上一条深超过一级，且至少为1级
+            # （同一遍中完成层级连续性修正，第一条最多为1级）
+            adjusted_level = max(1, min(item.predicted_level, last_level + 1))
             
-            result.append(TOCEntry(
-                title=entry.title,
-                level=current_level,
-                page=entry.page
-            ))
+            # 层级未变的条目直接复用，只为层级改变的条目创建新对象
+            if adjusted_level == entry.level:
+                validated.append(item)
+            else:
+                validated.append(item._replace(entry=TOCEntry(
+                    title=entry.title,
+                    level=adjusted_level,
+                    page=entry.page
+                )))
             
-            last_level = current_level
-        
-        return result
-    
-    def _final_quality_check(self, entries: List[TOCEntry]) -> List[TOCEntry]:
-        """最终质量检查和过滤"""
-        if not entries:
-            return entries
+            last_level = adjusted_level
         
-        filtered = []
-        
-        for entry in entries:
-            # 过滤明显不是标题的条目
-            if self._is_valid_title(entry.title):
-                filtered.append(entry)
-        
-        return filtered
+        return validated
     
-    def _is_valid_title(self, title: str) -> bool:
-        """判断是否为有效标题（更严格的标准）"""
-        title = title.strip()
-        
-        # 基本长度检查
-        if len(title) < 3 or len(title) > 50:
-            return False
-        
-        # 纯数字、日期或符号
-        if re.match(r'^[\d\s\.\-_年月日]+$', title):
-            return False
-        
-        # 以句号、感叹号、问号结尾的（可能是句子而非标题）
-        if re.search(r'[。！？]$', title):
-            return False
-        
-        # 包含过多标点符号的（可能是句子片段）
-        punctuation_count = len(re.findall(r'[，。；：！？""''（）]', title))
-        if punctuation_count > 2:
-            return False
-        
-        # 明显的排除模式
-        exclude_patterns = [
-            r'^图\s*\d+',
-            r'^表\s*\d+',
-            r'^Figure\s*\d+',
-            r'^Table\s*\d+',
-            r'第\s*\d+\s*页',
-            r'Page\s*\d+',
-            r'^参考文献',
-            r'^致谢',
-            r'^附录[A-Z]?$',
-            r'^\d{4}年',  # 纯年份
-            r'具体而言',   # 句子开头
-            r'根据.*',    # 句子开头
-            r'.*。.*',    # 包含句号的句子
-            r'^[a-z]+\.[a-z]+',  # 网址片段
-            r'双语优势',   # 描述性内容
-            r'语言考试替代', # 描述性内容
-            r'课程环境',   # 描述性内容
-            r'能力.*的.*', # 描述性句子模式
-            r'项目.*允许', # 描述性句子模式
-        ]
-        
-        for pattern in exclude_patterns:
-            if re.search(pattern, title, re.IGNORECASE):
-                return False
-        
-        # 检查是否有明确的标题格式
-        title_patterns = [
-            r'^第[一二三四五六七八九十\d]+章',
-            r'^第[一二三四五六七八九十\d]+节',
-            r'^[一二三四五六七八九十]\s*[、.]',
-            r'^\d+\s*[、.]',
-            r'^\d+\.\d+',
-            r'^\([一二三四五六七八九十\d]+\)',
-            r'^[①②③④⑤⑥⑦⑧⑨⑩]',
-        ]
-        
-        # 如果有明确的标题格式，直接通过
-        for pattern in title_patterns:
-            if re.match(pattern, title):
-                return True
-        
-        # 否则需要更严格的检查
-        # 不能包含太多的描述性词汇
-        descriptive_words = ['能力', '环境', '课程', '项目', '院校', '成绩', '证明', '具备', '允许', '作为', '同时', '发展', '状况', '情况', '内容', '方面']
-        descriptive_count = sum(1 for word in descriptive_words if word in title)
-        if descriptive_count > 1:
-            return False
-        
-        return True
-    
-    def format_for_pymupdf(self, entries: List[TOCEntry]) -> List[List]:
-        """
-        将目录条目格式化为PyMuPDF需要的格式
-        
-        Args:
-            entries: 目录条目列表
-            
-        Returns:
-            List[List]: PyMuPDF格式的目录列表
-        """
-        toc_list = []
-        
-        for entry in entries:
-            # PyMuPDF的目录格式：[level, title, page, zoom_info]
-            toc_item = [
-                entry.level,
-                entry.title,
-                entry.page
-            ]
-            toc_list.append(toc_item)
-        
-        return toc_list
+    def _final_quality_check(self, entries: List[_EnrichedEntry]) -> List[TOCEntry]:
+        """最终质量检查和过滤：去掉明显不是标题的条目，返回普通目录条目"""
+        return [item.entry for item in entries if item.is_valid]
     
     def print_toc_preview(self, entries: List[TOCEntry]) -> None:
         """
@@ -410,7 +380,6 @@ class AdvancedTOCMerger:
             entries: 目录条目列表
             output_path: 输出文件路径
         """
-        import json
         from dataclasses import asdict
         import time
         
@@ -434,8 +403,7 @@ class AdvancedTOCMerger:
             toc_data['metadata']['level_distribution'][level] = \
                 toc_data['metadata']['level_distribution'].get(level, 0) + 1
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(toc_data, f, ensure_ascii=False, indent=2)
+        json_utils.dump_to_file(toc_data, output_path)
         
         print(f"📄 增强目录已保存到: {output_path}")
 
@@ -9,31 +9,134 @@ import sys
 import tempfile
 import shutil
 from pathlib import Path
-from flask import Flask, render_template, request, send_file, flash, redirect, url_for, jsonify, session
+from urllib.parse import quote
+from dotenv import load_dotenv
+from flask import Flask, Request, Response, render_template, request, send_file, flash, redirect, url_for, jsonify, session, after_this_request
 import threading
 import time
 import uuid
+import signal
+import json
+import logging
+import io
+from collections import OrderedDict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 # 导入主要处理模块
-from gemini_extractor import GeminiTitleExtractor
+from gemini_extractor import GeminiTitleExtractor, MODEL_NAME
 from pdf_chunker import PDFChunker
 from toc_merger import TOCMerger
 from pdf_toc_writer import PDFTOCWriter
+from log_config import setup_logging
+from status_store import create_status_store
+from toc_cache import TOCCache, DEFAULT_CACHE_DIR, file_hash
+
+# 上传写盘缓冲区大小
+UPLOAD_BUFFER_SIZE = 1 << 20
+
+class UploadRequest(Request):
+    """上传的文件直接写入有路径的临时文件，保存时硬链接到任务目录，省去一次完整复制"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile('wb+', buffering=UPLOAD_BUFFER_SIZE, prefix='upload-')
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.secret_key = 'gemini-pdf-indexer-secret-key'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
 
-# 全局处理状态
-processing_status = {}
+# 每个任务同时向 Gemini 发送的块请求数（与命令行 --chunk-workers 默认值一致）
+CHUNK_WORKERS = 4
+CHUNK_PREFETCH = 2
+
+# 块进度未增加时，两次状态写入之间的最小间隔（秒）
+PROGRESS_UPDATE_INTERVAL = 1.0
+
+# 同时处理的上传任务数，超出的任务排队等待，不再每个上传各开一个线程
+JOB_WORKERS = int(os.getenv('GEMINI_WEB_JOB_WORKERS', '2'))
+job_executor = ThreadPoolExecutor(max_workers=max(1, JOB_WORKERS), thread_name_prefix='pdf-job')
+
+# 本进程排队和处理中的任务数上限，达到后新的上传返回 429，避免突发上传占满内存和磁盘
+MAX_PENDING_JOBS = int(os.getenv('GEMINI_WEB_MAX_PENDING_JOBS', '16'))
+_pending_jobs = 0
+_pending_jobs_lock = threading.Lock()
+
+# 接收上传前要求工作目录所在磁盘的剩余空间至少为上传大小的这么多倍（输入 + 输出 + 余量）；
+# 设置 GEMINI_WEB_DISK_QUOTA（字节）时，所有任务目录的总大小也不能超过该值
+UPLOAD_SPACE_FACTOR = 3
+DISK_QUOTA = int(os.getenv('GEMINI_WEB_DISK_QUOTA', '0'))
+
+logger = logging.getLogger(__name__)
+
+# 按 API Key 复用提取器（连接池、限流器、缓存），最多保留这么多个，按最近使用淘汰
+EXTRACTOR_CACHE_SIZE = 16
+_extractors = OrderedDict()
+_extractors_lock = threading.Lock()
+
+# 任务目录的父目录；交给前端代理发送文件时，代理的 internal location 指向这里
+WORK_DIR = os.getenv('GEMINI_WEB_WORK_DIR', os.path.join(tempfile.gettempdir(), 'gemini-pdf'))
+os.makedirs(WORK_DIR, exist_ok=True)
+
+# 任务目录名前缀；超过 TASK_DIR_MAX_AGE 秒未修改的任务目录视为遗留（未下载、进程重启等），
+# 启动时及之后每隔 TASK_DIR_SWEEP_INTERVAL 秒清理一次
+TASK_DIR_PREFIX = 'gemini-pdf-'
+TASK_ID_LENGTH = len(str(uuid.uuid4()))
+TASK_DIR_MAX_AGE = 3600
+TASK_DIR_SWEEP_INTERVAL = 600
+_last_sweep = None
+
+# 下载由前端代理直接发送：GEMINI_X_SENDFILE=1 输出 X-Sendfile（Apache/lighttpd），
+# GEMINI_X_ACCEL_PREFIX=/internal-downloads/ 输出 nginx 的 X-Accel-Redirect
+X_ACCEL_PREFIX = os.getenv('GEMINI_X_ACCEL_PREFIX', '')
+app.config['USE_X_SENDFILE'] = bool(X_ACCEL_PREFIX) or os.getenv('GEMINI_X_SENDFILE') == '1'
+
+# 代理发送文件时，应用无法得知何时发送完毕，延迟这么多秒后再删除任务目录
+PROXY_DOWNLOAD_CLEANUP_DELAY = 600
+
+# 不超过此大小的输出PDF直接保存在内存中下载，不写磁盘文件；
+# 仅在单进程状态存储且未交给代理发送文件时使用（其他进程和代理都读不到本进程内存）
+IN_MEMORY_OUTPUT_MAX_BYTES = 32 * 1024 * 1024
+_output_buffers = {}  # {任务ID: (PDF字节, 生成时间)}，超过 TASK_DIR_MAX_AGE 未下载的任务在清理时整体删除
+
+# 各任务共用的分块器、合并器和写入器（都不保存任务相关的状态，可在线程间共享）
+chunker = PDFChunker(max_pages=1000)
+merger = TOCMerger()
+writer = PDFTOCWriter()
+
+# 整份文档的目录缓存（按文件内容哈希），重复上传时跳过 Gemini 调用；按最近使用淘汰
+DOCUMENT_CACHE_MAX_ENTRIES = 1000
+document_cache = TOCCache(os.path.join(os.getenv('GEMINI_TOC_CACHE_DIR', DEFAULT_CACHE_DIR), 'documents'),
+                          max_entries=DOCUMENT_CACHE_MAX_ENTRIES)
+
+# 任务状态存储（默认进程内；设置 GEMINI_STATUS_DB 后多个工作进程共享 SQLite）
+status_store = create_status_store()
+
+# 长轮询：状态更新时唤醒等待中的 /status 请求
+STATUS_WAIT_TIMEOUT = 25
+MAX_STATUS_WAITERS = 32
+_status_waiters = threading.BoundedSemaphore(MAX_STATUS_WAITERS)
+
+# SSE 连接无更新时发送注释行的间隔（秒），防止代理因空闲断开连接
+SSE_KEEPALIVE_INTERVAL = 15
+
+def _update_status(task_id, fields):
+    """更新任务状态（写入 status_store；版本号和等待者的唤醒由存储负责）"""
+    status_store.update(task_id, fields)
+
+# 环境变量（及 .env 文件）中的 API Key 在启动时读取一次；修改 .env 后可向进程发送 SIGHUP 重新读取
+load_dotenv()
+_env_api_key = os.getenv('GOOGLE_AI_API_KEY', '')
+
+def reload_env_api_key(signum=None, frame=None):
+    """重新读取 .env 文件中的 API Key（SIGHUP 处理函数；运行中的进程环境无法从外部修改，只能从文件重新加载）"""
+    global _env_api_key
+    load_dotenv(override=True)
+    _env_api_key = os.getenv('GOOGLE_AI_API_KEY', '')
 
 def get_api_key():
     """获取API Key，优先从session，然后从环境变量"""
-    if 'custom_api_key' in session and session['custom_api_key']:
-        return session['custom_api_key']
-    
-    # 从环境变量读取
-    return os.getenv('GOOGLE_AI_API_KEY', '')
+    return session.get('custom_api_key') or _env_api_key
 
 @app.route('/')
 def index():
@@ -45,10 +148,9 @@ def index():
 @app.route('/settings')
 def settings():
     """设置页面"""
-    env_api_key = os.getenv('GOOGLE_AI_API_KEY', '')
     custom_api_key = session.get('custom_api_key', '')
     return render_template('settings.html', 
-                         env_api_key=bool(env_api_key), 
+                         env_api_key=bool(_env_api_key), 
                          custom_api_key=custom_api_key)
 
 @app.route('/save_settings', methods=['POST'])
@@ -68,63 +170,186 @@ def save_settings():
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """处理文件上传"""
+    # 在读取上传内容之前占用任务名额，任务已满时不再接收文件
+    if not _reserve_job_slot():
+        flash('服务器繁忙，排队的任务已满，请稍后再试', 'error')
+        return render_template('index.html', has_api_key=bool(get_api_key())), 429, {'Retry-After': '30'}
+    
+    # 未能提交任务时（检查未通过或保存失败）释放名额，提交后由任务结束回调释放
+    submitted = False
+    try:
+        response, submitted = _accept_upload()
+        return response
+    finally:
+        if not submitted:
+            _release_job_slot()
+
+def _accept_upload():
+    """
+    检查并保存上传文件，提交后台任务
+    
+    Returns:
+        Tuple: (响应, 是否已提交任务)
+    """
+    required = UPLOAD_SPACE_FACTOR * (request.content_length or app.config['MAX_CONTENT_LENGTH'])
+    if not _has_disk_space(required):
+        flash('服务器存储空间不足，请稍后再试', 'error')
+        return (render_template('index.html', has_api_key=bool(get_api_key())), 507), False
+    
     if 'pdf_file' not in request.files:
         flash('请选择一个PDF文件', 'error')
-        return redirect(url_for('index'))
+        return redirect(url_for('index')), False
     
     file = request.files['pdf_file']
     
     if file.filename == '':
         flash('请选择一个PDF文件', 'error')
-        return redirect(url_for('index'))
+        return redirect(url_for('index')), False
     
     # 获取API Key
     api_key = get_api_key()
     if not api_key:
         flash('请先设置Gemini API Key', 'error')
-        return redirect(url_for('settings'))
+        return redirect(url_for('settings')), False
     
     if file and file.filename.lower().endswith('.pdf'):
         # 生成唯一任务ID
         task_id = str(uuid.uuid4())
         
-        # 保存上传的文件
-        temp_dir = tempfile.mkdtemp()
+        # 保存上传的文件（目录名带任务ID，遗留的目录可以对应到任务）
+        _sweep_stale_task_dirs()
+        temp_dir = tempfile.mkdtemp(prefix=f'{TASK_DIR_PREFIX}{task_id}-', dir=WORK_DIR)
         input_path = os.path.join(temp_dir, file.filename)
-        file.save(input_path)
+        _save_upload(file, input_path)
         
         # 设置输出路径
         output_filename = file.filename.replace('.pdf', '_with_bookmarks.pdf')
         output_path = os.path.join(temp_dir, output_filename)
         
         # 初始化处理状态
-        processing_status[task_id] = {
-            'status': 'starting',
+        status_store.create(task_id, {
+            'status': 'queued',
             'progress': 0,
-            'message': '准备开始处理...',
+            'message': '排队等待处理...',
             'input_path': input_path,
             'output_path': output_path,
             'output_filename': output_filename,
             'temp_dir': temp_dir
-        }
+        })
         
-        # 启动后台处理线程
-        thread = threading.Thread(
-            target=process_pdf_background,
-            args=(task_id, input_path, output_path, api_key)
-        )
-        thread.daemon = True
-        thread.start()
+        # 提交到后台任务池，任务池线程都在忙时保持排队状态
+        future = job_executor.submit(process_pdf_background, task_id, input_path, output_path, api_key)
+        future.add_done_callback(_job_finished)
         
-        return redirect(url_for('processing', task_id=task_id))
+        return redirect(url_for('processing', task_id=task_id)), True
     
     flash('请上传有效的PDF文件', 'error')
-    return redirect(url_for('index'))
+    return redirect(url_for('index')), False
+
+def _sweep_stale_task_dirs():
+    """删除工作目录中过期的任务目录（距上次清理不足 TASK_DIR_SWEEP_INTERVAL 秒时跳过）"""
+    global _last_sweep
+    now = time.monotonic()
+    if _last_sweep is not None and now - _last_sweep < TASK_DIR_SWEEP_INTERVAL:
+        return
+    _last_sweep = now
+    
+    # 内存中的输出没有对应目录，按生成时间单独清理
+    for task_id, (_, created) in list(_output_buffers.items()):
+        if now - created > TASK_DIR_MAX_AGE:
+            _remove_task(task_id)
+    
+    cutoff = time.time() - TASK_DIR_MAX_AGE
+    try:
+        entries = list(os.scandir(WORK_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if not (entry.name.startswith(TASK_DIR_PREFIX) and entry.is_dir(follow_symlinks=False)
+                    and entry.stat(follow_symlinks=False).st_mtime < cutoff):
+                continue
+        except OSError:
+            continue
+        
+        # 目录修改时间在上传后不再变化，排队或处理中的任务即使超时也不能删除
+        task_id = entry.name[len(TASK_DIR_PREFIX):len(TASK_DIR_PREFIX) + TASK_ID_LENGTH]
+        status = status_store.get(task_id)
+        if status is not None and status['status'] not in ('completed', 'error'):
+            continue
+        if status is not None:
+            _remove_task(task_id)
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+def _has_disk_space(required):
+    """检查工作目录能否再容纳 required 字节（剩余空间及可选的总配额），不足时记录日志"""
+    try:
+        free = shutil.disk_usage(WORK_DIR).free
+    except OSError:
+        return True
+    if free < required:
+        logger.warning("⚠️  拒绝上传: 剩余空间 %s 字节，需要 %s 字节", free, required)
+        return False
+    
+    if DISK_QUOTA:
+        used = _directory_size(WORK_DIR)
+        if used + required > DISK_QUOTA:
+            logger.warning("⚠️  拒绝上传: 任务目录已用 %s 字节，需要 %s 字节，配额 %s 字节", used, required, DISK_QUOTA)
+            return False
+    return True
+
+def _directory_size(path):
+    """目录下所有文件的总字节数"""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += _directory_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
+
+def _reserve_job_slot():
+    """占用一个任务名额（检查和计数在同一把锁内完成），已达 MAX_PENDING_JOBS 时返回 False"""
+    global _pending_jobs
+    with _pending_jobs_lock:
+        if _pending_jobs >= MAX_PENDING_JOBS:
+            return False
+        _pending_jobs += 1
+        return True
+
+def _release_job_slot():
+    """释放一个任务名额"""
+    global _pending_jobs
+    with _pending_jobs_lock:
+        _pending_jobs -= 1
+
+def _job_finished(future):
+    """任务结束（成功或失败）时释放名额"""
+    _release_job_slot()
+
+def _save_upload(file, path):
+    """保存上传文件：同一文件系统上直接硬链接临时文件，否则回退到复制"""
+    name = getattr(file.stream, 'name', None)
+    if isinstance(name, str):
+        try:
+            file.stream.flush()
+            os.link(name, path)
+            return
+        except OSError:
+            pass
+    file.save(path)
 
 @app.route('/processing/<task_id>')
 def processing(task_id):
     """处理进度页面"""
-    if task_id not in processing_status:
+    if status_store.get(task_id) is None:
         flash('无效的任务ID')
         return redirect(url_for('index'))
     
@@ -132,84 +357,176 @@ def processing(task_id):
 
 @app.route('/status/<task_id>')
 def get_status(task_id):
-    """获取处理状态API"""
-    if task_id in processing_status:
-        return jsonify(processing_status[task_id])
+    """
+    获取处理状态API
+    
+    带 ?since=<version> 时为长轮询：状态版本号仍等于 since 时最多阻塞
+    STATUS_WAIT_TIMEOUT 秒，有更新立即返回。同时等待的请求数有上限，
+    超出时直接返回当前状态，避免占满服务器线程。
+    """
+    since = request.args.get('since', type=int)
+    if since is not None and _status_waiters.acquire(blocking=False):
+        try:
+            status = status_store.wait_for_change(task_id, since, STATUS_WAIT_TIMEOUT)
+        finally:
+            _status_waiters.release()
+    else:
+        status = status_store.get(task_id)
+    
+    if status is not None:
+        return jsonify(status)
     return jsonify({'status': 'not_found'}), 404
 
+@app.route('/events/<task_id>')
+def status_events(task_id):
+    """
+    以 Server-Sent Events 推送处理状态：一个连接上持续发送每次更新，任务结束后关闭
+    
+    与长轮询共用等待上限，超出时返回 503，页面会改用 /status 长轮询。
+    """
+    if status_store.get(task_id) is None:
+        return jsonify({'status': 'not_found'}), 404
+    if not _status_waiters.acquire(blocking=False):
+        return jsonify({'status': 'busy'}), 503
+    
+    def stream():
+        status = status_store.get(task_id)
+        while True:
+            if status is None:
+                yield f"data: {json.dumps({'status': 'not_found'})}\n\n"
+                return
+            yield f"data: {json.dumps(status, ensure_ascii=False)}\n\n"
+            if status['status'] in ('completed', 'error'):
+                return
+            
+            version = status['version']
+            while True:
+                status = status_store.wait_for_change(task_id, version, SSE_KEEPALIVE_INTERVAL)
+                if status is None or status['version'] != version or status['status'] in ('completed', 'error'):
+                    break
+                yield ": keepalive\n\n"
+    
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # nginx 不缓冲事件流
+    })
+    # 响应关闭时释放名额；HEAD 请求不会执行生成器，不能依赖生成器中的 finally
+    response.call_on_close(_status_waiters.release)
+    return response
+
 @app.route('/download/<task_id>')
 def download_file(task_id):
     """下载处理后的文件"""
-    if task_id not in processing_status:
+    status = status_store.get(task_id)
+    if status is None:
         flash('无效的任务ID')
         return redirect(url_for('index'))
     
-    status = processing_status[task_id]
     if status['status'] != 'completed':
         flash('文件还未处理完成')
         return redirect(url_for('processing', task_id=task_id))
     
-    if not os.path.exists(status['output_path']):
+    output_bytes = _output_buffers.get(task_id, (None,))[0]
+    if output_bytes is None and not os.path.exists(status['output_path']):
         flash('输出文件不存在')
         return redirect(url_for('index'))
     
-    return send_file(
+    @after_this_request
+    def remove_task_files(response):
+        if app.config['USE_X_SENDFILE']:
+            # 文件由代理在响应返回后读取，稍后再删除
+            _remove_task(task_id, delay=PROXY_DOWNLOAD_CLEANUP_DELAY)
+        else:
+            # send_file 此时已打开输出文件，删除目录后句柄仍可读到文件结束
+            _remove_task(task_id)
+        return response
+    
+    if output_bytes is not None:
+        return send_file(
+            io.BytesIO(output_bytes),
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name=status['output_filename']
+        )
+    
+    response = send_file(
         status['output_path'],
         as_attachment=True,
         download_name=status['output_filename']
     )
+    
+    if X_ACCEL_PREFIX:
+        relative_path = os.path.relpath(status['output_path'], WORK_DIR)
+        response.headers.pop('X-Sendfile', None)
+        response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative_path)
+    
+    return response
 
-def process_pdf_background(task_id, input_path, output_path, api_key):
-    """后台处理PDF文件"""
+def _remove_task(task_id, delay=0):
+    """删除任务状态和临时目录（delay 秒后再删除目录）"""
+    status = status_store.delete(task_id)
+    _output_buffers.pop(task_id, None)
+    temp_dir = status.get('temp_dir') if status else None
+    if not temp_dir:
+        return
+    
+    if delay:
+        timer = threading.Timer(delay, shutil.rmtree, args=(temp_dir,), kwargs={'ignore_errors': True})
+        timer.daemon = True
+        timer.start()
+    else:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def get_extractor(api_key):
+    """取得该 API Key 对应的提取器，不存在时创建"""
+    with _extractors_lock:
+        extractor = _extractors.pop(api_key, None)
+        if extractor is None:
+            extractor = GeminiTitleExtractor(api_key=api_key)
+        _extractors[api_key] = extractor
+        while len(_extractors) > EXTRACTOR_CACHE_SIZE:
+            _extractors.popitem(last=False)
+        return extractor
+
+def _extract_document_toc(task_id, input_path, api_key):
+    """分块调用 Gemini 提取标题并合并，返回最终目录条目"""
+    doc = chunker.open_pdf(input_path)
     try:
-        # 更新状态
-        processing_status[task_id].update({
-            'status': 'analyzing',
-            'progress': 10,
-            'message': '分析PDF文件...'
-        })
+        total_pages, file_size = chunker.get_pdf_info(doc)
         
-        # 分析PDF
-        chunker = PDFChunker(max_pages=1000)
-        total_pages, estimated_size = chunker.get_pdf_info(input_path)
-        
-        processing_status[task_id].update({
+        _update_status(task_id, {
             'progress': 20,
-            'message': f'文件信息: {total_pages}页, 预计{estimated_size:,}字符'
+            'message': f'文件信息: {total_pages}页, {file_size:,}字节'
         })
         
         # 分块处理
-        processing_status[task_id].update({
+        _update_status(task_id, {
             'status': 'chunking',
             'progress': 30,
             'message': '分块读取PDF...'
         })
         
-        chunks = chunker.chunk_pdf(input_path)
+        # 后台线程按需生成块（最多预先准备 CHUNK_PREFETCH 个），内存中只保留正在处理和排队的块
+        chunks = chunker.iter_chunks_prefetched(doc, prefetch=CHUNK_PREFETCH)
+        num_chunks = chunker.chunk_count(total_pages)
         
         # 初始化提取器
-        processing_status[task_id].update({
+        _update_status(task_id, {
             'status': 'extracting',
             'progress': 40,
             'message': '初始化Gemini AI...'
         })
         
-        extractor = GeminiTitleExtractor(api_key=api_key)
+        extractor = get_extractor(api_key)
         
         # 提取标题
-        processing_status[task_id].update({
+        _update_status(task_id, {
             'progress': 50,
             'message': '提取文档标题结构...'
         })
         
-        all_toc_entries = []
-        for i, (chunk_bytes, start_page, end_page) in enumerate(chunks):
-            progress = 50 + (i + 1) / len(chunks) * 30  # 50%-80%
-            processing_status[task_id].update({
-                'progress': int(progress),
-                'message': f'处理第 {start_page}-{end_page} 页...'
-            })
-            
+        def process_chunk(i, chunk_bytes, start_page, end_page):
+            """提取单个块的标题，返回 (块序号, 标题列表)"""
             try:
                 toc_entries = extractor.extract_titles_from_pdf_bytes(
                     chunk_bytes, start_page, end_page
@@ -218,62 +535,154 @@ def process_pdf_background(task_id, input_path, output_path, api_key):
                 # 回退到文本提取
                 text = chunker.extract_text_from_chunk(chunk_bytes)
                 toc_entries = extractor.extract_titles_from_text(text, start_page, end_page)
+            return i, toc_entries
+        
+        def process_group(i, group):
+            """相邻小块合并为一次请求提取，返回 (首块序号, 各块标题列表)；合并请求出错时逐块提取"""
+            if len(group) > 1:
+                try:
+                    return i, extractor.extract_titles_batched(group)
+                except Exception:
+                    pass  # 改为逐块提取，单块失败时还能回退到文本提取
+            return i, [process_chunk(i + k, *chunk)[1] for k, chunk in enumerate(group)]
+        
+        # 各组并发调用 Gemini（请求速率由提取器内的限流器控制），进度按完成的块数推进
+        chunk_workers = max(1, min(CHUNK_WORKERS, num_chunks))
+        results = {}
+        progress_step = 30.0 / max(1, num_chunks)  # 50%-80%（没有页面时不产生块）
+        last_progress, last_push_time = 50, time.monotonic()
+        with closing(chunks), ThreadPoolExecutor(max_workers=chunk_workers) as executor:
+            pending = {}
+            
+            def collect(done):
+                """记录已完成块的结果并更新进度（进度变化不足1%且距上次更新不到1秒时不写状态）"""
+                nonlocal last_progress, last_push_time
+                for future in done:
+                    start_page, end_page = pending.pop(future)
+                    i, group_results = future.result()
+                    for k, toc_entries in enumerate(group_results):
+                        results[i + k] = toc_entries
+                    progress = int(50 + len(results) * progress_step)
+                    now = time.monotonic()
+                    if (progress > last_progress or now - last_push_time >= PROGRESS_UPDATE_INTERVAL
+                            or len(results) == num_chunks):
+                        last_progress, last_push_time = progress, now
+                        _update_status(task_id, {
+                            'progress': progress,
+                            'message': f'完成第 {start_page}-{end_page} 页 ({len(results)}/{num_chunks})'
+                        })
             
-            all_toc_entries.append(toc_entries)
+            i = 0
+            for group in extractor.group_chunks(chunks):
+                if len(pending) >= chunk_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                
+                future = executor.submit(process_group, i, group)
+                pending[future] = (group[0][1], group[-1][2])
+                i += len(group)
+            
+            collect(as_completed(list(pending)))
+        
+        # 按块的原始顺序排列结果
+        all_toc_entries = [results[i] for i in range(len(results))]
         
         # 合并目录 - 使用与命令行版本相同的高级算法
-        processing_status[task_id].update({
+        _update_status(task_id, {
             'progress': 85,
             'message': '合并和排序目录...'
         })
         
-        merger = TOCMerger()
-        final_toc = merger.merge_toc_entries(all_toc_entries)
+        return merger.merge_toc_entries(all_toc_entries)
+    finally:
+        doc.close()
+
+def process_pdf_background(task_id, input_path, output_path, api_key):
+    """后台处理PDF文件"""
+    temp_dir = os.path.dirname(input_path)
+    try:
+        # 更新状态
+        _update_status(task_id, {
+            'status': 'analyzing',
+            'progress': 10,
+            'message': '分析PDF文件...'
+        })
+        
+        # 同一文档（内容相同、分块方式相同）之前处理过时直接使用缓存的目录
+        doc_key = f"{file_hash(input_path)}-{chunker.max_pages}-{MODEL_NAME}"
+        final_toc = document_cache.get(doc_key)
+        
+        if final_toc is None:
+            final_toc = _extract_document_toc(task_id, input_path, api_key)
+            if final_toc:
+                document_cache.set(doc_key, final_toc)
+        else:
+            _update_status(task_id, {
+                'progress': 90,
+                'message': '该文档之前处理过，使用缓存的目录结果'
+            })
         
         if not final_toc:
-            processing_status[task_id].update({
+            _update_status(task_id, {
                 'status': 'error',
                 'message': '未提取到任何目录条目，请检查PDF文档是否包含标题结构'
             })
             return
         
         # 写入目录
-        processing_status[task_id].update({
+        _update_status(task_id, {
             'progress': 95,
             'message': f'写入目录书签({len(final_toc)}个条目)...'
         })
         
-        writer = PDFTOCWriter()
-        writer.write_toc_to_pdf(input_path, final_toc, output_path)
+        if (not status_store.shared and not app.config['USE_X_SENDFILE']
+                and os.path.getsize(input_path) <= IN_MEMORY_OUTPUT_MAX_BYTES):
+            buffer = io.BytesIO()
+            writer.write_toc_to_stream(input_path, final_toc, buffer)
+            _output_buffers[task_id] = (buffer.getvalue(), time.monotonic())
+        else:
+            writer.write_toc_to_pdf(input_path, final_toc, output_path)
         
         # 完成
-        processing_status[task_id].update({
+        _update_status(task_id, {
             'status': 'completed',
             'progress': 100,
             'message': f'处理完成！提取了{len(final_toc)}个标题条目'
         })
         
     except Exception as e:
-        processing_status[task_id].update({
+        _update_status(task_id, {
             'status': 'error',
             'message': f'处理失败: {str(e)}'
         })
+    finally:
+        # 成功时只保留输出文件等待下载（输出在内存中时不再需要目录）；失败时整个临时目录都没有用了
+        status = status_store.get(task_id)
+        if status is not None and status['status'] == 'completed' and task_id not in _output_buffers:
+            try:
+                os.unlink(input_path)
+            except OSError:
+                pass
+        else:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
 @app.route('/cleanup/<task_id>')
 def cleanup_task(task_id):
     """清理任务文件"""
-    if task_id in processing_status:
-        temp_dir = processing_status[task_id].get('temp_dir')
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-        del processing_status[task_id]
-    
+    _remove_task(task_id)
     return redirect(url_for('index'))
 
 if __name__ == '__main__':
     # 创建templates目录
     os.makedirs('templates', exist_ok=True)
     
+    setup_logging()
+    _sweep_stale_task_dirs()
+    
+    # 只在直接运行时注册；gunicorn 等服务器自己处理 SIGHUP（重新加载工作进程）
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload_env_api_key)
+    
     print("🚀 启动Gemini PDF Indexer Web界面...")
     print("📱 访问地址: http://localhost:5000")
     print("🛑 按Ctrl+C停止服务")